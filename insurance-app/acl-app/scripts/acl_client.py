@@ -0,0 +1,90 @@
+import base64
+import time
+
+import httpx
+
+import crypto
+import unit_test_constants
+
+
+def hex_to_base64(hex_str):
+    # Convert the hex string to bytes
+    decoded_bytes = bytes.fromhex(hex_str)
+
+    # Encode the bytes to a base64 string
+    base64_str = base64.b64encode(decoded_bytes).decode("utf-8")
+
+    return base64_str
+
+
+class HTTPXClient:
+    def __init__(self, acl_url, identity: crypto.Identity, **kwargs):
+        self.acl_url = acl_url
+        self.identity = identity
+        self.session = httpx.Client(verify=identity.ssl_context(), **kwargs)
+
+    def get(self, path, *args, **kwargs) -> httpx.Response:
+        return self.session.request("GET", url=self.acl_url + path, *args, **kwargs)
+
+    def put(self, path, *args, **kwargs) -> httpx.Response:
+        return self.session.request("PUT", url=self.acl_url + path, *args, **kwargs)
+
+    def post(self, path, *args, **kwargs) -> httpx.Response:
+        return self.session.request("POST", url=self.acl_url + path, *args, **kwargs)
+
+    def patch(self, path, *args, **kwargs) -> httpx.Response:
+        return self.session.request("PATCH", url=self.acl_url + path, *args, **kwargs)
+
+    def fingerprint(self, verify=False) -> str:
+        """The fingerprint the ACL identifies this client by, computed from its
+        certificate. With verify, also checks that /app/ccf-cert agrees."""
+        fingerprint = self.identity.acl_fingerprint
+        if verify:
+            resp = self.get("/app/ccf-cert")
+            assert resp.status_code == 200, (resp.status_code, resp.text)
+            assert resp.text == fingerprint, (resp.text, fingerprint)
+        return fingerprint
+
+    def register_cases(self, incidents) -> httpx.Response:
+        return self.post("/app/cases/batch", json={"incidents": incidents})
+
+    def post_decisions(self, decisions) -> httpx.Response:
+        return self.post("/app/cases/decisions/batch", json={"decisions": decisions})
+
+    def iter_decisions(self, since=0, poll_interval=2.0):
+        """Yields each decision of the cases from case id since onwards in the
+        ACL's decision feed, as {caseId, decision, processor_fingerprint,
+        version}, waiting for more once it has caught up. Each pass reads the feed
+        from the first case still undecided (its low-water mark) to the latest
+        case, skipping decisions already yielded. Never returns, so stop iterating
+        when done."""
+        seen = set()
+        low = since
+        while True:
+            cursor, next_low, yielded = low, None, False
+            while True:
+                resp = self.get("/app/cases/decisions", params={"since": cursor})
+                assert resp.status_code == 200, (resp.status_code, resp.text)
+                page = resp.json()
+                for decision in page["decisions"]:
+                    if decision["caseId"] not in seen:
+                        seen.add(decision["caseId"])
+                        yielded = True
+                        yield decision
+                if next_low is None and page["lowWaterMark"] < page["next"]:
+                    next_low = page["lowWaterMark"]
+                if page["next"] == cursor:
+                    break
+                cursor = page["next"]
+            low = cursor if next_low is None else next_low
+            seen = {case_id for case_id in seen if case_id >= low}
+            if not yielded:
+                time.sleep(poll_interval)
+
+
+def processor_identity() -> crypto.Identity:
+    """The test processor's identity, whose attestation unit_test_constants holds."""
+    return crypto.Identity(
+        base64.b64decode(unit_test_constants.processor_privk).decode("ascii"),
+        base64.b64decode(unit_test_constants.processor_cert).decode("ascii"),
+    )
@@ -2,40 +2,8 @@ import argparse
 import json
 import httpx
 
-import time
-
 import crypto
-import base64
-
-
-def hex_to_base64(hex_str):
-    # Convert the hex string to bytes
-    decoded_bytes = bytes.fromhex(hex_str)
-
-    # Encode the bytes to a base64 string
-    base64_str = base64.b64encode(decoded_bytes).decode("utf-8")
-
-    return base64_str
-
-
-class HTTPXClient:
-    def __init__(self, acl_url, session_auth):
-        self.acl_url = acl_url
-        self.session_auth = session_auth
-        self.session = httpx.Client(verify=False, cert=session_auth)
-
-    def get(self, path, *args, **kwargs) -> httpx.Response:
-        return self.session.request("GET", url=self.acl_url + path, *args, **kwargs)
-
-    def put(self, path, *args, **kwargs) -> httpx.Response:
-        return self.session.request("PUT", url=self.acl_url + path, *args, **kwargs)
-
-    def post(self, path, *args, **kwargs) -> httpx.Response:
-        return self.session.request("POST", url=self.acl_url + path, *args, **kwargs)
-
-    def patch(self, path, *args, **kwargs) -> httpx.Response:
-        return self.session.request("PATCH", url=self.acl_url + path, *args, **kwargs)
-
+from acl_client import HTTPXClient, hex_to_base64
 
 USER_POLICY = "This policy covers all claims."
 USER_INCIDENT = "The policyholder hit another car."
@@ -49,15 +17,19 @@ parser.add_argument(
 )
 parser.add_argument("--acl-url", type=str, default="https://localhost:8000")
 parser.add_argument("--api-version", type=str, default="2024-08-22-preview")
+parser.add_argument(
+    "--verify-fingerprint",
+    action="store_true",
+    help="Check the locally computed certificate fingerprints against /app/ccf-cert.",
+)
 
 if __name__ == "__main__":
     args = parser.parse_args()
 
-    admin_identity = (args.admin_cert, args.admin_key)
+    admin_identity = crypto.Identity.from_files(args.admin_cert, args.admin_key)
     admin_client = HTTPXClient(args.acl_url, admin_identity)
 
-    client_keypath, client_certpath = crypto.generate_or_read_cert()
-    client_identity = client_certpath, client_keypath
+    client_identity = crypto.load_identity()
     client_client = HTTPXClient(args.acl_url, client_identity)
 
     # ---- Upload bundle ----
@@ -94,9 +66,7 @@ if __name__ == "__main__":
     ), (resp.status_code, resp.text)
 
     # ---- Registering admin as InsuranceAdmin ----
-    resp = admin_client.get("/app/ccf-cert")
-    assert resp.status_code == 200, (resp.status_code, resp.text)
-    admin_fingerprint = resp.text
+    admin_fingerprint = admin_client.fingerprint(args.verify_fingerprint)
     print(f"Adding {admin_fingerprint} as a InsuranceAdmin.")
 
     resp = admin_client.patch(
@@ -121,9 +91,7 @@ if __name__ == "__main__":
     ), f"Failed to set processor policy: {resp.status_code} {resp.text} | {resp.request.text}"
 
     # ---- Client registration ----
-    resp = client_client.get("/app/ccf-cert")
-    assert resp.status_code == 200, (resp.status_code, resp.text)
-    client_fingerprint = resp.text
+    client_fingerprint = client_client.fingerprint(args.verify_fingerprint)
 
     policy = input("Enter client policy: ")
     resp = admin_client.put(
@@ -137,6 +105,8 @@ if __name__ == "__main__":
     print("Registered client's policy.")
 
     # ---- Case processing ----
+    # Decisions for every case arrive on one feed, rather than polling each case
+    decisions = client_client.iter_decisions()
     while True:
 
         incident = input("Enter incident: ")
@@ -147,14 +117,8 @@ if __name__ == "__main__":
         caseId = int(resp.text)
         print("Registered client's case.")
 
-        while True:
-            print("Requesting decision...")
-            resp = client_client.get(f"/app/cases/indexed/{caseId}")
-            assert resp.status_code == 200, (resp.status_code, resp.text)
-
-            decision = resp.json()["metadata"]["decision"]["decision"]
-            if decision != "":
-                print(f"======= RECEIVED DECISION : {decision} =======")
+        print("Waiting for decision...")
+        for decision in decisions:
+            if decision["caseId"] == caseId:
+                print(f"======= RECEIVED DECISION : {decision['decision']} =======")
                 break
-
-            time.sleep(2)
\ No newline at end of file
@@ -1,139 +1,167 @@
-# Adapted from CCF infrastructure
-
-import datetime
-from typing import Tuple
-
-from cryptography import x509
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives.serialization import (
-    load_pem_private_key,
-    Encoding,
-    PrivateFormat,
-    PublicFormat,
-    NoEncryption,
-)
-from cryptography.x509.oid import NameOID
-
-import os
-import tempfile
+# Signing of ACL messages for these scripts. Keys, certificates and their
+# fingerprints come from the processor's identity module, installed from
+# c-aci with `pip install <repository-root>/insurance-app/c-aci`.
 
+import collections
+import concurrent.futures
+import functools
 import json
+import multiprocessing
+import os
 import time
+
+import cbor2
 import ccf.cose
+import pycose.headers
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+from pycose.messages import Sign1Message
+
+from identity import (
+    Identity,
+    KeyPool,
+    check_key_algorithm,
+    generate_cert,
+    generate_ec_keypair,
+    generate_rsa_keypair,
+    key_algorithms,
+    load_identity,
+)
 
-_RECOMMENDED_RSA_PUBLIC_EXPONENT = 65537
-
-
-def generate_rsa_keypair(key_size: int) -> Tuple[str, str]:
-    """Generates an RSA keypair, returning a Tuple of (pprivate key, public key)."""
-
-    priv = rsa.generate_private_key(
-        public_exponent=_RECOMMENDED_RSA_PUBLIC_EXPONENT,
-        key_size=key_size,
-        backend=default_backend(),
-    )
-    pub = priv.public_key()
-    priv_pem = priv.private_bytes(
-        Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()
-    ).decode("ascii")
-    pub_pem = pub.public_bytes(Encoding.PEM, PublicFormat.SubjectPublicKeyInfo).decode(
-        "ascii"
-    )
-    return priv_pem, pub_pem
-
-
-def generate_cert(
-    priv_key_pem: str, cn: str = "dummy"  # pylint: disable=invalid-name
-) -> str:
-    priv = load_pem_private_key(priv_key_pem.encode("ascii"), None, default_backend())
-    pub = priv.public_key()
-    subject = issuer = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)])
-    cert = (
-        x509.CertificateBuilder()
-        .subject_name(subject)
-        .issuer_name(issuer)
-        .public_key(pub)
-        .serial_number(x509.random_serial_number())
-        .not_valid_before(datetime.datetime.utcnow())
-        .not_valid_after(datetime.datetime.utcnow() + datetime.timedelta(days=10))
-        .sign(priv, hashes.SHA256(), default_backend())
-    )
-
-    return cert.public_bytes(Encoding.PEM).decode("ascii")
-
-
-def generate_or_read_cert(credential_root=None):
-    keypath = None
-    certpath = None
-    if credential_root is not None:
-        keypath = f"{credential_root}.privk.pem"
-        certpath = f"{credential_root}.cert.pem"
-
-    # Files exist so just use them
-    if keypath and os.path.isfile(keypath) and certpath and os.path.isfile(certpath):
-        print("Using stored credentials")
-        return keypath, certpath
-
-    # Files don't exist so write to them
-    if (keypath and not os.path.isfile(keypath)) or (
-        certpath and not os.path.isfile(certpath)
-    ):
-        print("Creating new credentials")
-        privk_pem_str, _ = generate_rsa_keypair(2048)
-        cert_pem_str = generate_cert(privk_pem_str)
-
-        with open(keypath, "w") as keyfile, open(certpath, "w") as certfile:
-            keyfile.write(privk_pem_str)
-            certfile.write(cert_pem_str)
-
-        return keypath, certpath
-
-    # Generate an ephemeral key
-    if keypath is None:
-        print("Using ephemeral credentials")
-        with tempfile.NamedTemporaryFile(
-            "w", suffix=".pem", delete=False
-        ) as keyfile, tempfile.NamedTemporaryFile(
-            "w", suffix=".pem", delete=False
-        ) as certfile:
-
-            # TODO ensure this is correct
-            privk_pem_str, _ = generate_rsa_keypair(2048)
-            cert_pem_str = generate_cert(privk_pem_str)
-
-            keyfile.write(privk_pem_str)
-            keyfile.flush()
-            certfile.write(cert_pem_str)
-            certfile.flush()
-
-            keypath = keyfile.name
-            certpath = certfile.name
-
-            return keypath, certpath
+__all__ = [
+    "Identity",
+    "KeyPool",
+    "SigningIdentity",
+    "canonical_json",
+    "check_key_algorithm",
+    "generate_cert",
+    "generate_ec_keypair",
+    "generate_rsa_keypair",
+    "key_algorithms",
+    "load_identity",
+    "load_signing_identity",
+    "sign_payload",
+    "sign_payloads",
+]
+
+
+# Hashes of the algorithms ccf.cose.default_algorithm_for_key picks, see RFC 9053
+_COSE_EC_HASHES = {
+    "ES256": hashes.SHA256,
+    "ES384": hashes.SHA384,
+    "ES512": hashes.SHA512,
+}
+
+
+class SigningIdentity(Identity):
+    """An identity for signing many ACL messages as COSE_Sign1 envelopes. The
+    envelopes are the ones ccf.cose.create_cose_sign1 builds, but the key and
+    certificate are parsed once rather than for every message."""
+
+    def __init__(self, key_pem: str, cert_pem: str):
+        super().__init__(key_pem, cert_pem)
+        if not isinstance(self.key, ec.EllipticCurvePrivateKey):
+            raise ValueError(
+                f"Unsupported key type {type(self.key).__name__}, ACL messages "
+                "are signed with EC keys"
+            )
+        self.alg = ccf.cose.default_algorithm_for_key(self.key.public_key())
+        self.hash = _COSE_EC_HASHES[self.alg]()
+        # ccf.cose uses the hex SHA-256 fingerprint of the certificate as kid
+        self.kid = self.fingerprint.encode("utf-8")
+        self.signature_size = (self.key.curve.key_size + 7) // 8
+
+    def signature(self, data: bytes) -> bytes:
+        # COSE signatures are r and s concatenated, rather than DER encoded
+        r, s = decode_dss_signature(self.key.sign(data, ec.ECDSA(self.hash)))
+        return r.to_bytes(self.signature_size, "big") + s.to_bytes(
+            self.signature_size, "big"
+        )
+
+    def sign_bytes(self, msg_type: str, payload: bytes) -> bytes:
+        msg = Sign1Message(
+            phdr={
+                pycose.headers.Algorithm: self.alg,
+                pycose.headers.KID: self.kid,
+                "acl.msg.type": msg_type,
+                "acl.msg.created_at": int(time.time()),
+            },
+            payload=payload,
+        )
+        # Signed as by ccf.cose.create_cose_sign1_prepare and _finish, with the
+        # parsed key rather than a pycose key, whose ECDSA is pure Python
+        to_sign = cbor2.dumps(["Signature1", msg.phdr_encoded, b"", payload])
+        msg._signature = self.signature(to_sign)
+        return msg.encode(sign=False)
+
+    def sign(self, msg_type: str, json_payload: dict) -> bytes:
+        return self.sign_bytes(msg_type, json.dumps(json_payload).encode())
+
+
+@functools.lru_cache(maxsize=None)
+def load_signing_identity(certpath: str, keypath: str) -> SigningIdentity:
+    return SigningIdentity.from_files(certpath, keypath)
 
 
 def sign_payload(identity, msg_type: str, json_payload: dict) -> bytes:
     cert, key = identity
-    serialised_payload = json.dumps(json_payload).encode()
-    with open(key, "r") as key_file:
-        key = key_file.read()
-    if not key:
-        raise ValueError("Key file is empty or improperly formatted.")
-    with open(cert, "r") as cert_file:
-        cert = cert_file.read()
-    if not cert:
-        raise ValueError("Cert file is empty or improperly formatted.")
-    phdr = {"acl.msg.type": msg_type, "acl.msg.created_at": int(time.time())}
-    return ccf.cose.create_cose_sign1(serialised_payload, key, cert, phdr)
-
-
-def format_cert_fingerprint(hex_string):
-    # Convert to uppercase
-    hex_string = hex_string.upper()
-    # Split into pairs of two characters and join with a colon
-    formatted_fingerprint = ":".join(
-        hex_string[i : i + 2] for i in range(0, len(hex_string), 2)
-    )
-    return formatted_fingerprint
+    return load_signing_identity(cert, key).sign(msg_type, json_payload)
+
+
+def canonical_json(json_payload) -> bytes:
+    """Serialises a payload the same way whatever its key order, so that equal
+    payloads always sign the same bytes."""
+    return json.dumps(
+        json_payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    ).encode("utf-8")
+
+
+# The SigningIdentity of a batch signing worker process
+_worker_identity = None
+
+
+def _init_signing_worker(key_pem: str, cert_pem: str):
+    global _worker_identity
+    _worker_identity = SigningIdentity(key_pem, cert_pem)
+
+
+def _sign_in_worker(msg_type: str, payload: bytes) -> bytes:
+    return _worker_identity.sign_bytes(msg_type, payload)
+
+
+def sign_payloads(identity: SigningIdentity, messages, processes=None, window=64):
+    """Signs each (msg_type, json_payload) in messages, yielding the envelopes in
+    the same order. Payloads are serialised as canonical JSON, once for a run of
+    the same payload object, such as one bundle signed for many ledgers. Signing
+    is spread over processes worker processes (one per core by default), or done
+    in this process if 0 or there is only one core. At most window messages are
+    in flight, so messages can be a generator of any length."""
+    last = [None, None]
+
+    def serialise(json_payload):
+        if last[0] is not json_payload:
+            last[:] = [json_payload, canonical_json(json_payload)]
+        return last[1]
+
+    if processes == 0 or (processes is None and os.cpu_count() == 1):
+        for msg_type, json_payload in messages:
+            yield identity.sign_bytes(msg_type, serialise(json_payload))
+        return
+
+    # Workers are spawned, so they do not inherit the caller's threads or state
+    with concurrent.futures.ProcessPoolExecutor(
+        processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_signing_worker,
+        initargs=(identity.key_pem, identity.cert_pem),
+    ) as executor:
+        in_flight = collections.deque()
+        for msg_type, json_payload in messages:
+            in_flight.append(
+                executor.submit(_sign_in_worker, msg_type, serialise(json_payload))
+            )
+            if len(in_flight) >= window:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
@@ -0,0 +1,81 @@
+import argparse
+import json
+import shutil
+import statistics
+import tempfile
+import time
+
+import crypto
+
+
+def summarise(values):
+    return {
+        "mean_ms": statistics.mean(values) * 1000,
+        "median_ms": statistics.median(values) * 1000,
+        "max_ms": max(values) * 1000,
+    }
+
+
+def benchmark_generation(algorithm, runs):
+    keypair_s, cert_s = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        privk_pem_str, _ = crypto.key_algorithms[algorithm]()
+        keypair_s.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        crypto.generate_cert(privk_pem_str)
+        cert_s.append(time.perf_counter() - start)
+    return {
+        "keypair": summarise(keypair_s),
+        "cert": summarise(cert_s),
+        "identity": summarise([k + c for k, c in zip(keypair_s, cert_s)]),
+    }
+
+
+def benchmark_pool(algorithm, runs):
+    """Times taking an identity from a pool filled ahead of time."""
+    directory = tempfile.mkdtemp()
+    try:
+        pool = crypto.KeyPool(directory, algorithm, size=runs)
+        pool.fill()
+        take_s = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            pool.take()
+            take_s.append(time.perf_counter() - start)
+        pool.refill_thread.join()
+        return summarise(take_s)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure how long creating an identity takes with each key "
+        "algorithm, and taking one from a filled key pool."
+    )
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument(
+        "--algorithms",
+        type=str,
+        default=",".join(crypto.key_algorithms),
+        help="Comma separated key algorithms to compare.",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="File to write the JSON report to."
+    )
+    args = parser.parse_args()
+
+    report = {"runs": args.runs, "algorithms": {}}
+    for algorithm in args.algorithms.split(","):
+        crypto.check_key_algorithm(algorithm)
+        print(f"Benchmarking {algorithm}", flush=True)
+        report["algorithms"][algorithm] = {
+            **benchmark_generation(algorithm, args.runs),
+            "pool_take": benchmark_pool(algorithm, args.runs),
+        }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,197 @@
+import argparse
+import concurrent.futures
+import json
+import statistics
+import threading
+import time
+
+import httpx
+
+import crypto
+import unit_test_constants
+from acl_client import HTTPXClient, hex_to_base64, processor_identity
+
+LOAD_TEST_POLICY = "This policy covers all claims."
+
+
+def summarise(latencies):
+    latencies = sorted(latencies)
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "p50_ms": percentiles[49] * 1000,
+        "p95_ms": percentiles[94] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+class Recorder:
+    """Records the latency of each operation in the order they complete, so that
+    the start of a phase can be compared with its end."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.failures = 0
+
+    def record(self, start, ok):
+        latency = time.perf_counter() - start
+        with self.lock:
+            if ok:
+                self.latencies.append(latency)
+            else:
+                self.failures += 1
+
+    def report(self, elapsed, window):
+        report = {
+            "operations": len(self.latencies),
+            "failures": self.failures,
+            "elapsed_s": elapsed,
+            "operations_per_s": len(self.latencies) / elapsed,
+        }
+        if len(self.latencies) >= 2:
+            report["latency"] = summarise(self.latencies)
+            window = max(2, min(window, len(self.latencies) // 2))
+            report["first_window"] = summarise(self.latencies[:window])
+            report["last_window"] = summarise(self.latencies[-window:])
+        return report
+
+
+def setup(admin_client, client_client, processor_client):
+    print("Setting processor policy")
+    resp = admin_client.put(
+        "/app/processor/policy",
+        json={"policies": [hex_to_base64(unit_test_constants.processor_policy)]},
+    )
+    assert resp.status_code == 200, (resp.status_code, resp.text)
+
+    print("Registering processor")
+    resp = processor_client.put(
+        "/app/processor", json=unit_test_constants.processor_registration_request
+    )
+    assert resp.status_code == 200, (resp.status_code, resp.text)
+
+    print("Registering client")
+    resp = admin_client.put(
+        "/app/user",
+        json={"cert": client_client.fingerprint(), "policy": LOAD_TEST_POLICY},
+    )
+    assert resp.status_code == 200, (resp.status_code, resp.text)
+
+
+def register_cases(client_client, cases, concurrency):
+    recorder = Recorder()
+
+    def register(index):
+        start = time.perf_counter()
+        try:
+            resp = client_client.post("/app/cases", data=f"Load test incident {index}")
+            recorder.record(start, resp.status_code == 200)
+        except httpx.HTTPError:
+            recorder.record(start, False)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(register, range(cases)))
+    return recorder, time.perf_counter() - start
+
+
+def drain_cases(processor_client, concurrency):
+    """Each worker takes and decides cases until the queue is empty, timing the
+    /cases/next calls, which are the ones which used to touch the whole queue."""
+    next_recorder = Recorder()
+    decision_recorder = Recorder()
+
+    def drain():
+        while True:
+            start = time.perf_counter()
+            try:
+                resp = processor_client.get("/app/cases/next")
+            except httpx.HTTPError:
+                next_recorder.record(start, False)
+                continue
+            if resp.status_code == 404:
+                return
+            next_recorder.record(start, resp.status_code == 200)
+            if resp.status_code != 200:
+                print(f"Failed to get next case: {resp.status_code} {resp.text}")
+                return
+
+            case = resp.json()
+            start = time.perf_counter()
+            try:
+                resp = processor_client.post(
+                    f"/app/cases/indexed/{case['caseId']}/decision",
+                    json={
+                        "incident": case["metadata"]["incident"],
+                        "policy": case["metadata"]["policy"],
+                        "decision": "approve",
+                    },
+                )
+                decision_recorder.record(start, resp.status_code == 200)
+            except httpx.HTTPError:
+                decision_recorder.record(start, False)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(drain) for _ in range(concurrency)]:
+            future.result()
+    return next_recorder, decision_recorder, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure case registration and processing throughput with many "
+        "pending cases. Expects the app to be deployed with the InsuranceAdmin role "
+        "assigned to the admin, e.g. by unit-test.py."
+    )
+    parser.add_argument("--admin-cert", type=str, help="Path to ACL admin certificate.")
+    parser.add_argument("--admin-key", type=str, help="Path to ACL admin private key.")
+    parser.add_argument("--acl-url", type=str, default="https://localhost:8000")
+    parser.add_argument(
+        "--cases",
+        type=int,
+        default=10000,
+        help="Number of cases to register before processing any of them.",
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=500,
+        help="Number of operations at the start and end of each phase to compare.",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="File to write the JSON report to."
+    )
+    args = parser.parse_args()
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    admin_identity = crypto.Identity.from_files(args.admin_cert, args.admin_key)
+    admin_client = HTTPXClient(args.acl_url, admin_identity)
+    client_client = HTTPXClient(args.acl_url, crypto.load_identity(), limits=limits)
+    processor_client = HTTPXClient(args.acl_url, processor_identity(), limits=limits)
+
+    setup(admin_client, client_client, processor_client)
+
+    print(f"Registering {args.cases} cases")
+    register_recorder, register_elapsed = register_cases(
+        client_client, args.cases, args.concurrency
+    )
+
+    print("Processing cases")
+    next_recorder, decision_recorder, drain_elapsed = drain_cases(
+        processor_client, args.concurrency
+    )
+
+    report = {
+        "cases": args.cases,
+        "concurrency": args.concurrency,
+        "register": register_recorder.report(register_elapsed, args.window),
+        "next": next_recorder.report(drain_elapsed, args.window),
+        "decision": decision_recorder.report(drain_elapsed, args.window),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
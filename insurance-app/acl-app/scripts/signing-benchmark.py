@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import time
+
+import ccf.cose
+from cryptography.hazmat.primitives.asymmetric import ec
+
+import crypto
+
+key_types = {
+    "ec-p256": lambda: crypto.generate_ec_keypair(ec.SECP256R1())[0],
+    "ec-p384": lambda: crypto.generate_ec_keypair(ec.SECP384R1())[0],
+}
+
+
+def synthetic_bundle(size):
+    """A userDefinedEndpoints-like bundle with roughly size bytes of module code."""
+    return {
+        "metadata": {"endpoints": {}},
+        "modules": [{"name": "insurance_app.js", "module": "x" * size}],
+    }
+
+
+def benchmark_ccf_cose(identity, msg_type, payload, messages):
+    """Signs as crypto.sign_payload used to, parsing the PEMs for every message."""
+    start = time.perf_counter()
+    for _ in range(messages):
+        ccf.cose.create_cose_sign1(
+            json.dumps(payload).encode(),
+            identity.key_pem,
+            identity.cert_pem,
+            {"acl.msg.type": msg_type, "acl.msg.created_at": int(time.time())},
+        )
+    return messages / (time.perf_counter() - start)
+
+
+def benchmark_sequential(identity, msg_type, payload, messages):
+    start = time.perf_counter()
+    for _ in range(messages):
+        identity.sign(msg_type, payload)
+    return messages / (time.perf_counter() - start)
+
+
+def benchmark_batch(identity, msg_type, payload, messages, processes):
+    start = time.perf_counter()
+    signed = 0
+    for _ in crypto.sign_payloads(
+        identity, ((msg_type, payload) for _ in range(messages)), processes
+    ):
+        signed += 1
+    assert signed == messages
+    return messages / (time.perf_counter() - start)
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure COSE_Sign1 signing throughput for each key type, one "
+        "message at a time and with crypto.sign_payloads."
+    )
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument(
+        "--processes",
+        type=int_list,
+        default=[0, os.cpu_count()],
+        help="Comma separated numbers of signing processes to compare, 0 signs "
+        "in this process.",
+    )
+    parser.add_argument(
+        "--key-types",
+        type=str,
+        default=",".join(key_types),
+        help="Comma separated key types to compare.",
+    )
+    parser.add_argument(
+        "--bundle",
+        type=str,
+        default=None,
+        help="Path to a bundle.json to sign. Defaults to a synthetic bundle.",
+    )
+    parser.add_argument(
+        "--bundle-size",
+        type=int,
+        default=64 * 1024,
+        help="Size in bytes of the synthetic bundle.",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="File to write the JSON report to."
+    )
+    args = parser.parse_args()
+
+    if args.bundle:
+        with open(args.bundle, "r") as bundle_file:
+            payload = json.load(bundle_file)
+    else:
+        payload = synthetic_bundle(args.bundle_size)
+
+    report = {
+        "messages": args.messages,
+        "payload_bytes": len(crypto.canonical_json(payload)),
+        "cpu_count": os.cpu_count(),
+        "key_types": {},
+    }
+    for key_type in args.key_types.split(","):
+        key_pem = key_types[key_type]()
+        identity = crypto.SigningIdentity(key_pem, crypto.generate_cert(key_pem))
+        print(f"Benchmarking {key_type}", flush=True)
+        report["key_types"][key_type] = {
+            "ccf_cose_per_s": benchmark_ccf_cose(
+                identity, "userDefinedEndpoints", payload, args.messages
+            ),
+            "sequential_per_s": benchmark_sequential(
+                identity, "userDefinedEndpoints", payload, args.messages
+            ),
+            "batch_per_s": {
+                processes: benchmark_batch(
+                    identity,
+                    "userDefinedEndpoints",
+                    payload,
+                    args.messages,
+                    processes,
+                )
+                for processes in args.processes
+            },
+        }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -1,43 +1,12 @@
 import argparse
 import json
 import httpx
-import tempfile
-import base64
 
 
 import crypto
 
 import unit_test_constants
-
-
-def hex_to_base64(hex_str):
-    # Convert the hex string to bytes
-    decoded_bytes = bytes.fromhex(hex_str)
-
-    # Encode the bytes to a base64 string
-    base64_str = base64.b64encode(decoded_bytes).decode("utf-8")
-
-    return base64_str
-
-
-class HTTPXClient:
-    def __init__(self, acl_url, session_auth):
-        self.acl_url = acl_url
-        self.session_auth = session_auth
-        self.session = httpx.Client(verify=False, cert=session_auth)
-
-    def get(self, path, *args, **kwargs) -> httpx.Response:
-        return self.session.request("GET", url=self.acl_url + path, *args, **kwargs)
-
-    def put(self, path, *args, **kwargs) -> httpx.Response:
-        return self.session.request("PUT", url=self.acl_url + path, *args, **kwargs)
-
-    def post(self, path, *args, **kwargs) -> httpx.Response:
-        return self.session.request("POST", url=self.acl_url + path, *args, **kwargs)
-
-    def patch(self, path, *args, **kwargs) -> httpx.Response:
-        return self.session.request("PATCH", url=self.acl_url + path, *args, **kwargs)
-
+from acl_client import HTTPXClient, hex_to_base64, processor_identity
 
 USER_POLICY = "This policy covers all claims."
 USER_INCIDENT = "The policyholder hit another car."
@@ -48,35 +17,24 @@ parser.add_argument("--admin-key", type=str, help="Path to ACL admin private key
 parser.add_argument("--bundle", type=str, help="Path to app bundle.json")
 parser.add_argument("--acl-url", type=str, default="https://localhost:8000")
 parser.add_argument("--api-version", type=str, default="2024-08-22-preview")
+parser.add_argument(
+    "--verify-fingerprint",
+    action="store_true",
+    help="Check the locally computed certificate fingerprints against /app/ccf-cert.",
+)
 
 if __name__ == "__main__":
     args = parser.parse_args()
 
-    admin_identity = (args.admin_cert, args.admin_key)
+    admin_identity = crypto.Identity.from_files(args.admin_cert, args.admin_key)
     admin_client = HTTPXClient(args.acl_url, admin_identity)
 
     print("Creating client")
-    client_keypath, client_certpath = crypto.generate_or_read_cert()
-    client_identity = client_certpath, client_keypath
+    client_identity = crypto.load_identity()
     client_client = HTTPXClient(args.acl_url, client_identity)
 
     print("Creating processor")
-    processor_keypath, processor_certpath = None, None
-    with tempfile.NamedTemporaryFile(
-        "wb", delete=False, suffix=".pem"
-    ) as certfile, tempfile.NamedTemporaryFile(
-        "wb", delete=False, suffix=".pem"
-    ) as keyfile:
-        cert = base64.b64decode(unit_test_constants.processor_cert)
-        certfile.write(cert)
-        certfile.flush()
-        processor_certpath = certfile.name
-        key = base64.b64decode(unit_test_constants.processor_privk)
-        keyfile.write(key)
-        keyfile.flush()
-        processor_keypath = keyfile.name
-    processor_identity = processor_certpath, processor_keypath
-    processor_client = HTTPXClient(args.acl_url, processor_identity)
+    processor_client = HTTPXClient(args.acl_url, processor_identity())
 
     # ---- Upload bundle ----
     module_name = "insurance_app.js"
@@ -112,9 +70,7 @@ if __name__ == "__main__":
     ), (resp.status_code, resp.text)
 
     # ---- Registering admin as InsuranceAdmin ----
-    resp = admin_client.get("/app/ccf-cert")
-    assert resp.status_code == 200
-    admin_fingerprint = resp.text
+    admin_fingerprint = admin_client.fingerprint(args.verify_fingerprint)
 
     resp = admin_client.patch(
         f"/app/ledgerUsers/{admin_fingerprint}?api-version={args.api_version}",
@@ -148,9 +104,7 @@ if __name__ == "__main__":
 
     # ---- Client registration ----
     print("Registering client")
-    resp = client_client.get("/app/ccf-cert")
-    assert resp.status_code == 200
-    client_fingerprint = resp.text
+    client_fingerprint = client_client.fingerprint(args.verify_fingerprint)
 
     resp = admin_client.put(
         "/app/user",
@@ -163,6 +117,10 @@ if __name__ == "__main__":
 
     # ---- Client incident processing ----
 
+    # Cases without an incident could never be decided
+    resp = client_client.post("/app/cases", data="")
+    assert resp.status_code == 400, f"{resp.status_code} {resp.text}"
+
     # Client registers case
     print("Registering case")
     resp = client_client.post("/app/cases", data=USER_INCIDENT)
@@ -184,12 +142,13 @@ if __name__ == "__main__":
         and resp.json()["metadata"] == expected_pre_decision_case_metadata
     ), f"{resp.status_code} {resp.text}"
 
-    # Requesting another case returns current one
+    # The case is leased to the processor, so there is no other case to process
     resp = processor_client.get("/app/cases/next")
-    assert (
-        resp.status_code == 200
-        and resp.json()["metadata"] == expected_pre_decision_case_metadata
-    )
+    assert resp.status_code == 404, f"{resp.status_code} {resp.text}"
+
+    # Only registered processors can take cases
+    resp = client_client.get("/app/cases/next")
+    assert resp.status_code == 403, f"{resp.status_code} {resp.text}"
 
     # No decision while processing
     resp = client_client.get(f"/app/cases/indexed/{caseId}")
@@ -222,4 +181,90 @@ if __name__ == "__main__":
 
     assert resp.json()["metadata"]["decision"]["decision"] == "approve"
 
+    # ---- Batch case processing ----
+
+    # Client registers several cases at once, invalid ones are rejected individually
+    print("Registering cases in a batch")
+    resp = client_client.register_cases([USER_INCIDENT, USER_INCIDENT, 1, ""])
+    assert resp.status_code == 200, f"{resp.status_code} {resp.text}"
+    results = resp.json()["results"]
+    assert [r["statusCode"] for r in results] == [200, 200, 400, 400], results
+    batch_case_ids = [r["caseId"] for r in results[:2]]
+
+    # Processor takes up to count cases at once
+    print("Getting batch of cases")
+    resp = processor_client.get("/app/cases/next", params={"count": 0})
+    assert resp.status_code == 400, f"{resp.status_code} {resp.text}"
+    resp = processor_client.get("/app/cases/next", params={"count": 5})
+    assert (
+        resp.status_code == 200
+        and [case["caseId"] for case in resp.json()["cases"]] == batch_case_ids
+    ), f"{resp.status_code} {resp.text}"
+
+    # Processor stores decisions together, unknown cases and invalid decisions
+    # are rejected individually
+    print("Storing decisions in a batch")
+    resp = processor_client.post_decisions(
+        [
+            {
+                "caseId": case_id,
+                "incident": USER_INCIDENT,
+                "policy": USER_POLICY,
+                "decision": "deny",
+            }
+            for case_id in batch_case_ids
+        ]
+        + [
+            {
+                "caseId": batch_case_ids[-1] + 100,
+                "incident": USER_INCIDENT,
+                "policy": USER_POLICY,
+                "decision": "deny",
+            },
+            {
+                "caseId": batch_case_ids[0],
+                "incident": USER_INCIDENT,
+                "policy": USER_POLICY,
+                "decision": "maybe",
+            },
+        ]
+    )
+    assert resp.status_code == 200, f"{resp.status_code} {resp.text}"
+    results = resp.json()["results"]
+    assert [r["statusCode"] for r in results] == [200, 200, 404, 400], results
+
+    for case_id in batch_case_ids:
+        resp = client_client.get(f"/app/cases/indexed/{case_id}")
+        assert (
+            resp.status_code == 200
+            and resp.json()["metadata"]["decision"]["decision"] == "deny"
+        ), f"{resp.status_code} {resp.text}"
+
+    # Only registered processors can store decisions
+    resp = client_client.post_decisions([])
+    assert resp.status_code == 403, f"{resp.status_code} {resp.text}"
+
+    # ---- Decision feed ----
+
+    # The decisions above are in the feed, which is read in case id order from
+    # the first of them until it catches up
+    print("Reading decision feed")
+    feed = {}
+    since = caseId
+    while True:
+        resp = client_client.get("/app/cases/decisions", params={"since": since})
+        assert resp.status_code == 200, f"{resp.status_code} {resp.text}"
+        page = resp.json()
+        for decision in page["decisions"]:
+            feed[decision["caseId"]] = decision["decision"]
+        assert since <= page["lowWaterMark"] <= page["next"], page
+        if page["next"] == since:
+            break
+        since = page["next"]
+    expected = {caseId: "approve"} | {case_id: "deny" for case_id in batch_case_ids}
+    assert {case_id: feed.get(case_id) for case_id in expected} == expected, feed
+
+    resp = client_client.get("/app/cases/decisions", params={"since": -1})
+    assert resp.status_code == 400, f"{resp.status_code} {resp.text}"
+
     print("Unit test successful")
@@ -1,5 +1,6 @@
 import * as ccfapp from "@microsoft/ccf-app";
-import { MAP_PREFIX, SINGLETON_KEY } from "./common";
+import { ccf } from "@microsoft/ccf-app/global";
+import { MAP_PREFIX, SINGLETON_KEY, parseRequestQuery } from "./common";
 import { isValidProcessor, ProcessorMetadata } from "./processor_registration";
 import { getPolicy } from "./user_registration";
 
@@ -26,38 +27,135 @@ const kvCases = ccfapp.typedKv(
   ccfapp.json<CaseMetadata>(),
 );
 
-const kvCaseQueue = ccfapp.typedKv(
+// Processors back off between polls while the queue is empty, but should not
+// poll again sooner than this.
+const IDLE_RETRY_AFTER_SECONDS = 1;
+
+// A case handed to a processor is leased to it, so that it is not handed to
+// another processor unless the lease expires before a decision is stored.
+const LEASE_DURATION_MS = 5 * 60 * 1000;
+
+interface CaseLease {
+  processor_fingerprint: string;
+  expiry: number;
+}
+
+const kvCaseLeases = ccfapp.typedKv(
+  MAP_PREFIX + "caseLeases",
+  ccfapp.int32,
+  ccfapp.json<CaseLease>(),
+);
+
+// Every lease lasts as long, so leases expire in the order they are granted.
+// Each grant is appended to a queue of leases, and expired leases are found by
+// walking it from the head until a lease which has not expired yet, rather than
+// by reading every lease. Entries whose case was decided or leased again since
+// are dropped as the head passes them.
+interface LeaseQueueEntry {
+  caseId: number;
+  expiry: number;
+}
+
+const kvLeaseQueue = ccfapp.typedKv(
+  MAP_PREFIX + "leaseQueue",
+  ccfapp.int32,
+  ccfapp.json<LeaseQueueEntry>(),
+);
+
+const kvLeaseQueueHead = ccfapp.typedKv(
+  MAP_PREFIX + "leaseQueueHead",
+  ccfapp.arrayBuffer,
+  ccfapp.int32,
+);
+
+const kvLeaseQueueTail = ccfapp.typedKv(
+  MAP_PREFIX + "leaseQueueTail",
+  ccfapp.arrayBuffer,
+  ccfapp.int32,
+);
+
+function now(): number {
+  ccf.enableUntrustedDateTime(true);
+  return Date.now();
+}
+
+// Case ids are assigned in order, so the queue is every case from the head up
+// to the next case id, and the case metadata doubles as the queue entries.
+// Taking a case only writes the head and registering one only writes the tail
+// (the next case id) and the new case, so neither contends with the other.
+const kvCaseQueueHead = ccfapp.typedKv(
+  MAP_PREFIX + "caseQueueHead",
+  ccfapp.arrayBuffer,
+  ccfapp.int32,
+);
+
+// Previously the whole queue was stored as a single array
+const kvLegacyCaseQueue = ccfapp.typedKv(
   MAP_PREFIX + "caseQueue",
   ccfapp.arrayBuffer,
   ccfapp.json<number[]>(),
 );
 
-function getCaseQueue(): number[] {
-  if (!kvCaseQueue.has(SINGLETON_KEY)) {
-    kvCaseQueue.set(SINGLETON_KEY, []);
+function getCaseQueueHead(): number {
+  const head = kvCaseQueueHead.get(SINGLETON_KEY);
+  if (head !== undefined) {
+    return head;
   }
 
-  return kvCaseQueue.get(SINGLETON_KEY);
+  // Ledgers with the legacy queue start from its oldest case
+  const legacyQueue = kvLegacyCaseQueue.get(SINGLETON_KEY);
+  if (legacyQueue !== undefined && legacyQueue.length > 0) {
+    return legacyQueue.reduce((a, b) => Math.min(a, b));
+  }
+  const nextCaseId = kvCaseId.get(SINGLETON_KEY);
+  return nextCaseId === undefined ? 0 : nextCaseId;
 }
 
-export function registerCase(
-  request: ccfapp.Request<string>,
-): ccfapp.Response<string> {
-  let incident = request.body.text();
-
-  const callerId = acl.certUtils.convertToAclFingerprintFormat();
-  const policy = getPolicy(callerId);
-  if (policy === undefined) {
-    return { statusCode: 404, body: "No policy found for this user" };
+// Takes up to count cases from the head of the queue, skipping any which were
+// decided without being taken from the queue.
+function takeQueuedCases(count: number): number[] {
+  const initialHead = getCaseQueueHead();
+  let head = initialHead;
+  const taken: number[] = [];
+  while (taken.length < count) {
+    const caseMetadata = kvCases.get(head);
+    if (caseMetadata === undefined) {
+      break;
+    }
+    if (caseMetadata.decision.decision === "") {
+      taken.push(head);
+    }
+    head += 1;
   }
 
-  var case_id_int = kvCaseId.get(SINGLETON_KEY);
-  if (case_id_int === undefined) {
-    case_id_int = 0;
+  if (head !== initialHead) {
+    kvCaseQueueHead.set(SINGLETON_KEY, head);
   }
-  kvCaseId.set(SINGLETON_KEY, case_id_int + 1);
-  const case_id = case_id_int;
+  return taken;
+}
+
+// Batch endpoints handle every item in a single transaction, so the number of
+// items is limited to keep transactions small.
+const MAX_BATCH_SIZE = 500;
+
+// The outcome of one item of a batch request, with the status code and error
+// the equivalent single item request would have returned.
+interface BatchItemResult {
+  caseId?: number;
+  statusCode: number;
+  error?: string;
+}
+
+interface RespBatch {
+  results: BatchItemResult[];
+}
 
+function getNextCaseId(): number {
+  const case_id = kvCaseId.get(SINGLETON_KEY);
+  return case_id === undefined ? 0 : case_id;
+}
+
+function storeNewCase(case_id: number, incident: string, policy: string) {
   kvCases.set(case_id, {
     incident,
     policy,
@@ -66,10 +164,27 @@ export function registerCase(
       processor_fingerprint: "",
     },
   });
+}
+
+export function registerCase(
+  request: ccfapp.Request<string>,
+): ccfapp.Response<string> {
+  let incident = request.body.text();
+  // Processors reject decisions for empty incidents, so they would never be
+  // decided
+  if (!incident) {
+    return { statusCode: 400, body: "Missing or invalid incident" };
+  }
 
-  let caseQueue = getCaseQueue();
-  caseQueue.push(case_id);
-  kvCaseQueue.set(SINGLETON_KEY, caseQueue);
+  const callerId = acl.certUtils.convertToAclFingerprintFormat();
+  const policy = getPolicy(callerId);
+  if (policy === undefined) {
+    return { statusCode: 404, body: "No policy found for this user" };
+  }
+
+  const case_id = getNextCaseId();
+  kvCaseId.set(SINGLETON_KEY, case_id + 1);
+  storeNewCase(case_id, incident, policy);
 
   return {
     statusCode: 200,
@@ -77,40 +192,169 @@ export function registerCase(
   };
 }
 
+interface ReqRegisterCases {
+  incidents: string[];
+}
+
+export function registerCases(
+  request: ccfapp.Request<ReqRegisterCases>,
+): ccfapp.Response<RespBatch | string> {
+  try {
+    var { incidents } = request.body.json();
+    if (!Array.isArray(incidents)) {
+      return { statusCode: 400, body: "Missing or invalid incidents" };
+    }
+    if (incidents.length > MAX_BATCH_SIZE) {
+      return {
+        statusCode: 400,
+        body: `At most ${MAX_BATCH_SIZE} incidents can be registered at once`,
+      };
+    }
+  } catch (error) {
+    return {
+      statusCode: 400,
+      body: "Exception while parsing request: " + error.message,
+    };
+  }
+
+  const callerId = acl.certUtils.convertToAclFingerprintFormat();
+  const policy = getPolicy(callerId);
+  if (policy === undefined) {
+    return { statusCode: 404, body: "No policy found for this user" };
+  }
+
+  let case_id = getNextCaseId();
+  const results = incidents.map((incident): BatchItemResult => {
+    if (!incident || typeof incident !== "string") {
+      return { statusCode: 400, error: "Missing or invalid incident" };
+    }
+    storeNewCase(case_id, incident, policy);
+    case_id += 1;
+    return { caseId: case_id - 1, statusCode: 200 };
+  });
+  kvCaseId.set(SINGLETON_KEY, case_id);
+
+  return { statusCode: 200, body: { results } };
+}
+
 interface RespNextCase {
   metadata: CaseMetadata;
   caseId: number;
+  leaseExpiry: number;
+}
+
+interface RespNextCases {
+  cases: RespNextCase[];
+}
+
+function getLeaseQueueTail(): number {
+  const tail = kvLeaseQueueTail.get(SINGLETON_KEY);
+  if (tail !== undefined) {
+    return tail;
+  }
+
+  // Leases granted before the lease queue was added are queued once, in the
+  // order they expire
+  const leases: LeaseQueueEntry[] = [];
+  kvCaseLeases.forEach((lease, caseId) => {
+    leases.push({ caseId, expiry: lease.expiry });
+  });
+  leases.sort((a, b) => a.expiry - b.expiry || a.caseId - b.caseId);
+  leases.forEach((entry, index) => kvLeaseQueue.set(index, entry));
+  kvLeaseQueueHead.set(SINGLETON_KEY, 0);
+  kvLeaseQueueTail.set(SINGLETON_KEY, leases.length);
+  return leases.length;
+}
+
+function grantLease(caseId: number, lease: CaseLease) {
+  const tail = getLeaseQueueTail();
+  kvLeaseQueue.set(tail, { caseId, expiry: lease.expiry });
+  kvLeaseQueueTail.set(SINGLETON_KEY, tail + 1);
+  kvCaseLeases.set(caseId, lease);
+}
+
+// Returns up to count cases whose leases have expired without a decision,
+// in the order they expired.
+function expiredLeases(time: number, count: number): number[] {
+  const tail = getLeaseQueueTail();
+  const storedHead = kvLeaseQueueHead.get(SINGLETON_KEY);
+  const initialHead = storedHead === undefined ? 0 : storedHead;
+  let head = initialHead;
+  const expired: number[] = [];
+  while (expired.length < count && head < tail) {
+    const entry = kvLeaseQueue.get(head);
+    if (entry !== undefined) {
+      const lease = kvCaseLeases.get(entry.caseId);
+      if (lease !== undefined && lease.expiry === entry.expiry) {
+        if (lease.expiry > time) {
+          break;
+        }
+        expired.push(entry.caseId);
+      }
+      kvLeaseQueue.delete(head);
+    }
+    head += 1;
+  }
+
+  if (head !== initialHead) {
+    kvLeaseQueueHead.set(SINGLETON_KEY, head);
+  }
+  return expired;
 }
 
 export function nextCase(
   request: ccfapp.Request,
-): ccfapp.Response<RespNextCase | string> {
-  let caseQueue = getCaseQueue();
+): ccfapp.Response<RespNextCase | RespNextCases | string> {
+  const callerId = acl.certUtils.convertToAclFingerprintFormat();
+  if (!isValidProcessor(callerId)) {
+    return { statusCode: 403, body: "Invalid processor" };
+  }
 
-  if (caseQueue.length <= 0) {
+  // With a count, up to that many cases are returned as a list
+  const countParam = parseRequestQuery(request)["count"];
+  const count = countParam === undefined ? 1 : Number(countParam);
+  if (!Number.isInteger(count) || count < 1 || count > MAX_BATCH_SIZE) {
+    return {
+      statusCode: 400,
+      body: `count must be an integer from 1 to ${MAX_BATCH_SIZE}`,
+    };
+  }
+
+  const time = now();
+  const case_ids = expiredLeases(time, count);
+  if (case_ids.length < count) {
+    case_ids.push(...takeQueuedCases(count - case_ids.length));
+  }
+  if (case_ids.length === 0) {
     return {
       statusCode: 404,
+      headers: { "retry-after": String(IDLE_RETRY_AFTER_SECONDS) },
       body: "No cases found",
     };
   }
 
-  let case_id = caseQueue.shift();
-
-  // Re-add case such that if this processor fails, it will be picked by another processor
-  caseQueue.push(case_id);
-  kvCaseQueue.set(SINGLETON_KEY, caseQueue);
+  const cases: RespNextCase[] = [];
+  for (const case_id of case_ids) {
+    const metadata = kvCases.get(case_id);
+    if (metadata === undefined) {
+      return {
+        statusCode: 500,
+        body: `Case ${case_id} in case queue but not in store.`,
+      };
+    }
 
-  if (!kvCases.has(case_id)) {
-    return {
-      statusCode: 500,
-      body: `Case ${case_id} in case queue but not in store.`,
+    const lease = {
+      processor_fingerprint: callerId,
+      expiry: time + LEASE_DURATION_MS,
     };
+    grantLease(case_id, lease);
+    cases.push({ caseId: case_id, metadata, leaseExpiry: lease.expiry });
   }
 
-  return {
-    statusCode: 200,
-    body: { caseId: case_id, metadata: kvCases.get(case_id) },
-  };
+  if (countParam === undefined) {
+    return { statusCode: 200, body: cases[0] };
+  }
+  return { statusCode: 200, body: { cases } };
 }
 
 interface RespCaseDecision {
@@ -151,12 +395,141 @@ export function getCaseMetadata(
   };
 }
 
+interface DecisionFeedEntry extends Decision {
+  caseId: number;
+  version: number;
+}
+
+interface RespDecisionFeed {
+  decisions: DecisionFeedEntry[];
+  next: number;
+  lowWaterMark: number;
+}
+
+export function getDecisions(
+  request: ccfapp.Request,
+): ccfapp.Response<RespDecisionFeed | string> {
+  const query = parseRequestQuery(request);
+  const since = query["since"] === undefined ? 0 : Number(query["since"]);
+  if (!Number.isInteger(since) || since < 0) {
+    return { statusCode: 400, body: "since must be a non-negative integer" };
+  }
+  const limit =
+    query["limit"] === undefined ? MAX_BATCH_SIZE : Number(query["limit"]);
+  if (!Number.isInteger(limit) || limit < 1 || limit > MAX_BATCH_SIZE) {
+    return {
+      statusCode: 400,
+      body: `limit must be an integer from 1 to ${MAX_BATCH_SIZE}`,
+    };
+  }
+
+  // The feed is read back from the cases in case id order, rather than from a
+  // log of decisions, so that storing a decision only writes its own case.
+  // next always moves past the cases read, and lowWaterMark is the first of
+  // them still undecided, from which clients read again for later decisions.
+  const end = Math.max(since, Math.min(since + limit, getNextCaseId()));
+  const decisions: DecisionFeedEntry[] = [];
+  let lowWaterMark = end;
+  for (let caseId = since; caseId < end; caseId++) {
+    const caseMetadata = kvCases.get(caseId);
+    if (caseMetadata === undefined) {
+      continue;
+    }
+    if (caseMetadata.decision.decision === "") {
+      lowWaterMark = Math.min(lowWaterMark, caseId);
+      continue;
+    }
+    decisions.push({
+      caseId,
+      ...caseMetadata.decision,
+      version: kvCases.getVersionOfPreviousWrite(caseId),
+    });
+  }
+
+  return { statusCode: 200, body: { decisions, next: end, lowWaterMark } };
+}
+
 interface ReqPutCaseDecision {
   incident: string;
   policy: string;
   decision: string;
 }
 
+const possible_decisions = new Set(["approve", "deny", "error"]);
+
+function validateDecision(body: ReqPutCaseDecision): string | undefined {
+  const { incident, policy, decision } = body;
+  if (!incident || typeof incident !== "string") {
+    return "Missing or invalid incident";
+  }
+
+  if (!policy || typeof policy !== "string") {
+    return "Missing or invalid policy";
+  }
+
+  if (
+    !decision ||
+    typeof decision !== "string" ||
+    !possible_decisions.has(decision)
+  ) {
+    return "Missing or invalid decision";
+  }
+  return undefined;
+}
+
+// Stores a validated decision from a registered processor, returning the
+// status code and the error if it cannot be stored.
+function storeDecision(
+  caseId: number,
+  body: ReqPutCaseDecision,
+  callerId: string,
+  time: number,
+): BatchItemResult {
+  let caseMetadata = kvCases.get(caseId);
+  if (!caseMetadata) {
+    return { caseId, statusCode: 404, error: "Case not found" };
+  }
+  if (caseMetadata.decision.decision !== "") {
+    return {
+      caseId,
+      statusCode: 400,
+      error: "Already stored decision for case.",
+    };
+  }
+
+  if (
+    caseMetadata.incident !== body.incident ||
+    caseMetadata.policy !== body.policy
+  ) {
+    return {
+      caseId,
+      statusCode: 400,
+      error: "Expected case metadata does not match processed metadata",
+    };
+  }
+
+  const lease = kvCaseLeases.get(caseId);
+  if (
+    lease !== undefined &&
+    lease.processor_fingerprint !== callerId &&
+    lease.expiry > time
+  ) {
+    return {
+      caseId,
+      statusCode: 409,
+      error: "Case is leased to another processor.",
+    };
+  }
+
+  kvCases.set(caseId, {
+    ...caseMetadata,
+    decision: { decision: body.decision, processor_fingerprint: callerId },
+  });
+  kvCaseLeases.delete(caseId);
+
+  return { caseId, statusCode: 200 };
+}
+
 export function putCaseDecision(
   request: ccfapp.Request<ReqPutCaseDecision>,
 ): ccfapp.Response<any | string> {
@@ -170,23 +543,10 @@ export function putCaseDecision(
     }
     var caseId = Number(caseIdParam);
 
-    var { incident, policy, decision } = request.body.json();
-
-    if (!incident || typeof incident !== "string") {
-      return { statusCode: 400, body: "Missing or invalid incident" };
-    }
-
-    if (!policy || typeof policy !== "string") {
-      return { statusCode: 400, body: "Missing or invalid policy" };
-    }
-
-    const possible_decisions = new Set(["approve", "deny", "error"]);
-    if (
-      !decision ||
-      typeof decision !== "string" ||
-      !possible_decisions.has(decision)
-    ) {
-      return { statusCode: 400, body: "Missing or invalid decision" };
+    var body = request.body.json();
+    const error = validateDecision(body);
+    if (error !== undefined) {
+      return { statusCode: 400, body: error };
     }
   } catch (error) {
     return {
@@ -195,18 +555,44 @@ export function putCaseDecision(
     };
   }
 
-  let caseMetadata = kvCases.get(caseId);
-  if (!caseMetadata) {
-    return { statusCode: 404, body: "Case not found" };
+  const callerId = acl.certUtils.convertToAclFingerprintFormat();
+  if (!isValidProcessor(callerId)) {
+    return { statusCode: 403, body: "Invalid processor" };
   }
-  if (caseMetadata.decision.decision !== "") {
-    return { statusCode: 400, body: "Already stored decision for case." };
+
+  const result = storeDecision(caseId, body, callerId, now());
+  if (result.statusCode !== 200) {
+    return { statusCode: result.statusCode, body: result.error };
   }
+  return { statusCode: 200 };
+}
+
+interface ReqPutCaseDecisionBatchItem extends ReqPutCaseDecision {
+  caseId: number;
+}
+
+interface ReqPutCaseDecisions {
+  decisions: ReqPutCaseDecisionBatchItem[];
+}
 
-  if (caseMetadata.incident !== incident || caseMetadata.policy !== policy) {
+export function putCaseDecisions(
+  request: ccfapp.Request<ReqPutCaseDecisions>,
+): ccfapp.Response<RespBatch | string> {
+  try {
+    var { decisions } = request.body.json();
+    if (!Array.isArray(decisions)) {
+      return { statusCode: 400, body: "Missing or invalid decisions" };
+    }
+    if (decisions.length > MAX_BATCH_SIZE) {
+      return {
+        statusCode: 400,
+        body: `At most ${MAX_BATCH_SIZE} decisions can be stored at once`,
+      };
+    }
+  } catch (error) {
     return {
       statusCode: 400,
-      body: "Expected case metadata does not match processed metadata",
+      body: "Exception while parsing request: " + error.message,
     };
   }
 
@@ -215,13 +601,17 @@ export function putCaseDecision(
     return { statusCode: 403, body: "Invalid processor" };
   }
 
-  kvCases.set(caseId, {
-    ...caseMetadata,
-    decision: { decision, processor_fingerprint: callerId },
+  const time = now();
+  const results = decisions.map((item): BatchItemResult => {
+    if (!item || !Number.isInteger(item.caseId)) {
+      return { statusCode: 400, error: "Missing or invalid caseId" };
+    }
+    const error = validateDecision(item);
+    if (error !== undefined) {
+      return { caseId: item.caseId, statusCode: 400, error };
+    }
+    return storeDecision(item.caseId, item, callerId, time);
   });
-  let queue = getCaseQueue();
-  let filtered_queue = queue.filter((val, idx, arr) => val != caseId);
-  kvCaseQueue.set(SINGLETON_KEY, filtered_queue);
 
-  return { statusCode: 200 };
+  return { statusCode: 200, body: { results } };
 }
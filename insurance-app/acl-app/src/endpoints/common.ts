@@ -51,6 +51,19 @@ export function equal_uint8array(a: Uint8Array, b: Uint8Array): boolean {
   return true;
 }
 
+export function parseRequestQuery(
+  request: ccfapp.Request<any>,
+): Record<string, string> {
+  const query: Record<string, string> = {};
+  for (const element of request.query.split("&")) {
+    const [key, value] = element.split("=");
+    if (key) {
+      query[key] = value;
+    }
+  }
+  return query;
+}
+
 export function getCallerCert(
   request: ccfapp.Request<any>,
 ): ccfapp.Response<string> {
@@ -6,15 +6,29 @@ import base64
 import hashlib
 
 import requests
+from requests.adapters import HTTPAdapter
 
 import argparse
-import crypto
+import identity
 
 import time
 
-from phi import Phi
+from phi import Phi, preamble, kv_cache_types
+from decision_cache import DecisionCache
+from file_digest import cached_file_digest
+from attestation_cache import AttestationCache
+from inference_pool import InferencePool
+
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import queue
+import random
+import threading
+
+import httpx
 
-import tempfile
 import os
 
 # disables the "verify=False" warnings, as the request to pin the ca raise the warning
@@ -23,76 +37,407 @@ import urllib3
 urllib3.disable_warnings()
 
 
-class ProcessorDaemon:
-    def __init__(self, uds_sock, acl_url, phi_repeats, model_path=None):
-        if model_path:
-            self.phi = Phi(model_path=model_path)
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.count = 0
+        self.busy = 0.0
+
+    def record(self, seconds, count=1):
+        with self.lock:
+            self.count += count
+            self.busy += seconds
+
+    def report(self, elapsed):
+        with self.lock:
+            count, busy = self.count, self.busy
+        # Average time per item, so batches are spread over their cases
+        average = busy / count if count else 0.0
+        return f"{self.name}: {count} ({count / elapsed:.2f}/s, avg {average:.2f}s)"
+
+
+class StartupTimeline:
+    """When each startup phase ran, relative to the processor being created, to
+    show what is on the critical path to the first decision."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.phases = []
+
+    def now(self):
+        return time.monotonic() - self.start
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append((name, start, self.now()))
+
+    def mark(self, name):
+        now = self.now()
+        with self.lock:
+            self.phases.append((name, now, now))
+
+    def report(self):
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        return "Startup timeline:\n" + "\n".join(
+            f"  {start:8.3f}s - {end:8.3f}s  {name}" for name, start, end in phases
+        )
+
+
+class PollBackoff:
+    """Delay between polls for the next case while there are none, growing
+    exponentially up to maximum, with jitter so processors spread out."""
+
+    def __init__(self, initial=0.1, maximum=10.0, factor=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.delay = 0.0
+
+    def reset(self):
+        self.delay = 0.0
+
+    def next_delay(self, retry_after=None):
+        if self.delay == 0.0:
+            self.delay = self.initial
         else:
+            self.delay = min(self.delay * self.factor, self.maximum)
+        delay = random.uniform(self.delay / 2, self.delay)
+        # The ACL may ask to wait before polling again, but never beyond the cap
+        if retry_after is not None:
+            delay = min(max(delay, retry_after), self.maximum)
+        return delay
+
+
+def retry_after(response):
+    try:
+        return float(response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+def env_flag(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in {"1", "true", "yes", "on"}
+
+
+def thread_candidates():
+    # The container's CPU quota is usually below the number of visible cores, so
+    # the best thread count has to be measured.
+    cores = len(os.sched_getaffinity(0))
+    return sorted({max(1, cores // 4), max(1, cores // 2), cores})
+
+
+def registration_payload(attest_report):
+    return {
+        "attestation": base64.b64encode(attest_report.attestation).decode("ascii"),
+        "platform_certificates": base64.b64encode(
+            attest_report.platform_certificates
+        ).decode("ascii"),
+        "uvm_endorsements": base64.b64encode(attest_report.uvm_endorsements).decode(
+            "ascii"
+        ),
+    }
+
+
+def parse_next_case(body):
+    if "caseId" not in body:
+        raise ValueError(f"Body does not contain caseId: {body}")
+    try:
+        int(body["caseId"])
+    except ValueError:
+        raise ValueError(f"Body.caseId is not an integer: {body['caseId']}")
+    if "metadata" not in body:
+        raise ValueError(f"Body does not contain any metadata: {body}")
+    metadata = body["metadata"]
+    if "incident" not in metadata:
+        raise ValueError(f"Metadata does not contain incident: {metadata}")
+    if "policy" not in metadata:
+        raise ValueError(f"Metadata does not contain policy: {metadata}")
+
+    return {
+        "incident": metadata["incident"],
+        "policy": metadata["policy"],
+        "caseId": int(body["caseId"]),
+        # Milliseconds since the epoch, if the ACL leased the case
+        "leaseExpiry": body.get("leaseExpiry"),
+    }
+
+
+class ProcessorDaemon:
+    def __init__(
+        self,
+        uds_sock,
+        acl_url,
+        phi_repeats,
+        model_path=None,
+        persist_prefix_cache=False,
+        engine="generate",
+        decision_cache_size=0,
+        decision_cache_path=None,
+        http_pool_size=4,
+        http_timeout=30,
+        min_poll_interval=0.1,
+        max_poll_interval=10.0,
+        attestation_timeout=10.0,
+        attestation_cache_dir=None,
+        phi_options=None,
+        prime_phi=False,
+        auto_tune=False,
+        inference_processes=0,
+        prefetch=1,
+        lease_margin=30.0,
+        key_algorithm="rsa-2048",
+        key_pool_dir=None,
+        verify_fingerprint=False,
+        credential_root=None,
+    ):
+        self.timeline = StartupTimeline()
+        if not model_path:
             localpath = os.path.dirname(os.path.abspath(__file__))
-            self.phi = Phi(os.path.join(localpath, "Phi-3-mini-4k-instruct-q4.gguf"))
+            model_path = os.path.join(localpath, "Phi-3-mini-4k-instruct-q4.gguf")
+        self.model_path = model_path
+        self.persist_prefix_cache = persist_prefix_cache
+        self.engine = engine
+        # Passed on to Phi, e.g. n_threads, n_batch, use_mmap or type_k
+        self.phi_options = dict(phi_options or {})
+        if auto_tune and inference_processes > 0:
+            raise ValueError(
+                "Auto-tuning is not supported with inference processes, which "
+                "split the cores between them. Set n_threads instead."
+            )
+        self.inference_processes = inference_processes
         self.uds_sock = f"unix://{uds_sock}"
         self.raw_acl_url = acl_url
         self.acl_url = "https://" + acl_url
         self.phi_repeats = phi_repeats
 
-        keypath, certpath = crypto.generate_or_read_cert()
-        self.cert = (certpath, keypath)
+        self.decision_cache = None
+        if decision_cache_size > 0:
+            self.decision_cache = DecisionCache(
+                decision_cache_size, decision_cache_path
+            )
+
+        key_pool = None
+        if key_pool_dir is not None:
+            key_pool = identity.KeyPool(key_pool_dir, key_algorithm)
+        self.identity = identity.load_identity(
+            credential_root, algorithm=key_algorithm, key_pool=key_pool
+        )
+        # The ACL identifies the processor by this, which is attested to
+        self.fingerprint = self.identity.acl_fingerprint
+        self.verify_fingerprint = verify_fingerprint
+
+        # Reports attest to the certificate, so remain usable for as long as it does
+        self.cert_expiry = self.identity.expiry
+        self.attestation_cache = AttestationCache(attestation_cache_dir)
+        self.attestation_timeout = attestation_timeout
+        self.attestation_container = None
+
+        self.session = None
+        self.http_pool_size = http_pool_size
+        self.http_timeout = http_timeout
+
+        self.backoff = PollBackoff(min_poll_interval, max_poll_interval)
+        self.retry_after = None
+
+        # Cases fetched and leased together, waiting to be handed out one at a time
+        self.prefetch = prefetch
+        self.prefetched = collections.deque()
+        # Cases whose lease expires within lease_margin seconds are dropped rather
+        # than decided, as the ACL may already be handing them to another
+        # processor. The lease duration and the time between cases handed out
+        # limit how many cases are leased at once.
+        self.lease_margin = lease_margin
+        self.lease_duration = None
+        self.case_interval = None
+        self.last_handout = None
+        self.first_decision_posted = False
+
+        # The model loads and warms up while the processor registers with the ACL,
+        # but cases are only claimed once it is ready.
+        self.phi = None
+        self.phi_error = None
+        self.phi_ready = threading.Event()
+        threading.Thread(
+            target=self.load_phi, args=(prime_phi, auto_tune), daemon=True
+        ).start()
+
+    def hash_model(self):
+        with self.timeline.phase("model digest"):
+            print(f"Hashing {self.model_path} for the decision cache", flush=True)
+            return cached_file_digest(self.model_path)
+
+    def load_phi(self, prime_phi=False, auto_tune=False):
+        try:
+            model_digest = None
+            if self.decision_cache is not None:
+                # Hashed while the model loads, rather than before it
+                executor = concurrent.futures.ThreadPoolExecutor(1)
+                model_digest = executor.submit(self.hash_model)
+                executor.shutdown(wait=False)
+            if self.inference_processes > 0:
+                # Workers load and warm up their models in parallel
+                with self.timeline.phase("inference pool start"):
+                    self.phi = self.create_inference_pool(prime_phi)
+            else:
+                with self.timeline.phase("model load"):
+                    self.phi = self.create_phi()
+            if (prime_phi or auto_tune) and self.inference_processes == 0:
+                with self.timeline.phase("warm-up"):
+                    self.prime_phi(auto_tune)
+            if model_digest is not None:
+                self.model_digest = model_digest.result()
+        except Exception as e:
+            print("Exception while loading the model.", flush=True)
+            print(e, flush=True)
+            self.phi_error = e
+        finally:
+            self.phi_ready.set()
+
+    def wait_for_phi(self):
+        if not self.phi_ready.is_set():
+            print("Waiting for the model to be ready", flush=True)
+        self.phi_ready.wait()
+        if self.phi_error is not None:
+            raise self.phi_error
+        self.timeline.mark("claiming cases")
+
+    def record_decision_posted(self):
+        if not self.first_decision_posted:
+            self.first_decision_posted = True
+            self.timeline.mark("first decision posted")
+            print(self.timeline.report(), flush=True)
+
+    def phi_kwargs(self):
+        return {
+            "persist_prefix_cache": self.persist_prefix_cache,
+            "engine": self.engine,
+            **self.phi_options,
+        }
+
+    def create_phi(self):
+        return Phi(self.model_path, **self.phi_kwargs())
+
+    def create_inference_pool(self, prime=False):
+        kwargs = self.phi_kwargs()
+        # Split the cores between the workers, unless told otherwise
+        if kwargs.get("n_threads") is None:
+            cores = len(os.sched_getaffinity(0))
+            kwargs["n_threads"] = max(1, cores // self.inference_processes)
+        print(
+            f"Starting {self.inference_processes} inference processes with "
+            f"{kwargs['n_threads']} threads each",
+            flush=True,
+        )
+        return InferencePool(self.inference_processes, self.model_path, kwargs, prime)
+
+    def prime_phi(self, auto_tune=False):
+        incident = "The policyholder hit a car"
+        policy = "This policy approves all claims."
+        self.phi.process_incident(incident, policy)
+        if auto_tune:
+            n_threads, timings = self.phi.tune_threads(
+                incident, policy, thread_candidates()
+            )
+            print(f"Using {n_threads} threads, timings: {timings}", flush=True)
+            # Any further models, e.g. for pipeline workers, use the same setting
+            self.phi_options["n_threads"] = n_threads
 
     def attest_data(self, report_data: bytes) -> bytes:
+        report = self.attestation_cache.get(report_data)
+        if report is not None:
+            print("Using cached attestation", flush=True)
+            return report
+
+        # The channel is kept for the lifetime of the processor
+        if self.attestation_container is None:
+            print(f"Connecting to attestation sidecar at: {self.uds_sock}", flush=True)
+            channel = grpc.insecure_channel(self.uds_sock)
+            grpc.channel_ready_future(channel).result(timeout=self.attestation_timeout)
+            self.attestation_container = as_grpc.AttestationContainerStub(channel)
+
         print(f"Getting attestation from: {self.uds_sock}", flush=True)
-        stub = as_grpc.AttestationContainerStub(grpc.insecure_channel(self.uds_sock))
-        report = stub.FetchAttestation(
-            as_pb.FetchAttestationRequest(report_data=report_data)
+        report = self.attestation_container.FetchAttestation(
+            as_pb.FetchAttestationRequest(report_data=report_data),
+            timeout=self.attestation_timeout,
         )
+        self.attestation_cache.put(report_data, report, self.cert_expiry)
         return report
 
+    def check_fingerprint(self, res):
+        """Checks the fingerprint computed from the certificate against the one the
+        ACL reports for it."""
+        if res.status_code != 200:
+            print(res, res.text, flush=True)
+            raise ValueError(
+                "Unable to set up connection to ACL. Perhaps the app has not been loaded?"
+            )
+        if res.text != self.fingerprint:
+            raise ValueError(
+                f"ACL reports certificate fingerprint {res.text}, expected "
+                f"{self.fingerprint}"
+            )
+
+    def create_client(self):
+        # A single session keeps connections to the ACL alive, so polling and
+        # posting decisions do not pay for a new mutual TLS handshake every time.
+        self.session = requests.Session()
+        # requests only loads client certificates from files
+        self.session.cert = self.identity.cert_files()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=self.http_pool_size))
+
     def setup_acl(self):
+        self.create_client()
+
         # There is no safety issue in this sample for a MIM attack so we pin the certificate
         # This can also be baked into the container image, or released via a SKR service.
         # TODO make all other calls also use this CA (currently broken due to auth checks)
         print("Pinning acl service certificate", flush=True)
-        res = requests.get(
-            "https://" + self.raw_acl_url + "/node/network", verify=False
+        res = self.session.get(
+            "https://" + self.raw_acl_url + "/node/network",
+            timeout=self.http_timeout,
+            verify=False,
         )
         if res.status_code != 200:
             print(res, res.text, flush=True)
             raise ValueError(
                 "Unable to set up connection to ACL. Perhaps the app has not been loaded?"
             )
-        service_cert = res.json()["service_certificate"]
-        with tempfile.NamedTemporaryFile("w", suffix=".pem", delete=False) as cafile:
-            cafile.write(service_cert)
-            cafile.flush()
-            self.acl_ca = cafile.name
+        # The PEM of the service certificate, which ssl contexts take as cadata
+        self.acl_ca = res.json()["service_certificate"]
 
-        print("Getting ccf_format certificate fingerprint", flush=True)
-        res = requests.get(self.acl_url + "/app/ccf-cert", cert=self.cert, verify=False)
-        if res.status_code != 200:
-            print(res, res.text, flush=True)
-            raise ValueError(
-                "Unable to set up connection to ACL. Perhaps the app has not been loaded?"
+        if self.verify_fingerprint:
+            print("Checking ccf_format certificate fingerprint", flush=True)
+            self.check_fingerprint(
+                self.session.get(
+                    self.acl_url + "/app/ccf-cert",
+                    timeout=self.http_timeout,
+                    verify=False,
+                )
             )
 
-        self.fingerprint = res.text
-
-        attest_report = self.attest_data(
-            hashlib.sha256(self.fingerprint.encode("utf-8")).digest()
-        )
+        with self.timeline.phase("attestation"):
+            attest_report = self.attest_data(
+                hashlib.sha256(self.fingerprint.encode("utf-8")).digest()
+            )
 
-        payload = {
-            "attestation": base64.b64encode(attest_report.attestation).decode("ascii"),
-            "platform_certificates": base64.b64encode(
-                attest_report.platform_certificates
-            ).decode("ascii"),
-            "uvm_endorsements": base64.b64encode(attest_report.uvm_endorsements).decode(
-                "ascii"
-            ),
-        }
+        payload = registration_payload(attest_report)
         register_url = self.acl_url + "/app/processor"
         print(f"Registering with ACL at: {register_url}", flush=True)
-        response = requests.put(
-            register_url, cert=self.cert, json=payload, verify=False
-        )
+        with self.timeline.phase("registration"):
+            response = self.session.put(
+                register_url, json=payload, timeout=self.http_timeout, verify=False
+            )
         if response.status_code != 200:
             print("Failed to register with ACL. Exiting now", flush=True)
             print(response, response.text, flush=True)
@@ -100,38 +445,129 @@ class ProcessorDaemon:
 
         print("Successfully registered with ACL", flush=True)
 
-    def get_acl_incident_and_policy(self):
-        res = requests.get(
-            self.acl_url + "/app/cases/next", cert=self.cert, verify=False
-        )
+    def prefetch_count(self):
+        # Only lease as many cases as can be handed out before their lease is
+        # within the margin of expiring
+        if self.lease_duration is None or not self.case_interval:
+            return self.prefetch
+        usable = self.lease_duration - self.lease_margin
+        return max(1, min(self.prefetch, int(usable / self.case_interval)))
+
+    def next_cases_url(self):
+        if self.prefetch > 1:
+            return self.acl_url + f"/app/cases/next?count={self.prefetch_count()}"
+        return self.acl_url + "/app/cases/next"
+
+    def lease_expiring(self, job):
+        expiry = job.get("leaseExpiry")
+        return expiry is not None and expiry / 1000 - time.time() < self.lease_margin
+
+    def drop_expiring(self, jobs):
+        """Returns the jobs whose leases are not about to expire."""
+        kept = []
+        for job in jobs:
+            if self.lease_expiring(job):
+                print(
+                    f"Dropping case {job['caseId']}, whose lease expires within "
+                    f"{self.lease_margin}s",
+                    flush=True,
+                )
+            else:
+                kept.append(job)
+        return kept
+
+    def buffer_cases(self, res):
+        self.retry_after = retry_after(res)
         if res.status_code == 404:
-            return None
+            return
         if res.status_code not in {200}:
-            raise ValueError("Error while getting next incident" + res.text())
+            raise ValueError("Error while getting next incident" + res.text)
 
         body = res.json()
-        if "caseId" not in body:
-            raise ValueError(f"Body does not contain caseId: {body}")
-        try:
-            int(body["caseId"])
-        except ValueError:
-            raise ValueError(f"Body.caseId is not an integer: {body['caseId']}")
-        if "metadata" not in body:
-            raise ValueError(f"Body does not contain any metadata: {body}")
-        metadata = body["metadata"]
-        if "incident" not in metadata:
-            raise ValueError(f"Metadata does not contain incident: {metadata}")
-        if "policy" not in metadata:
-            raise ValueError(f"Metadata does not contain policy: {metadata}")
+        if self.prefetch <= 1:
+            cases = [parse_next_case(body)]
+        else:
+            if not isinstance(body, dict) or not isinstance(body.get("cases"), list):
+                raise ValueError(f"Body does not contain a list of cases: {body}")
+            # A malformed case should not hold up the others fetched with it
+            cases = []
+            for case in body["cases"]:
+                try:
+                    cases.append(parse_next_case(case))
+                except (ValueError, TypeError) as e:
+                    print(f"Skipping invalid case: {e}", flush=True)
+        if cases and cases[0]["leaseExpiry"] is not None:
+            self.lease_duration = cases[0]["leaseExpiry"] / 1000 - time.time()
+        self.prefetched.extend(cases)
 
-        return {
-            "incident": metadata["incident"],
-            "policy": metadata["policy"],
-            "caseId": int(body["caseId"]),
-        }
+    def next_buffered_case(self):
+        while self.prefetched:
+            job = self.prefetched.popleft()
+            if not self.drop_expiring([job]):
+                continue
+            # Only cases handed out from the same fetch are timed, so waiting for
+            # new cases does not count
+            now = time.monotonic()
+            if self.last_handout is not None:
+                interval = now - self.last_handout
+                self.case_interval = (
+                    interval
+                    if self.case_interval is None
+                    else 0.8 * self.case_interval + 0.2 * interval
+                )
+            self.last_handout = now if self.prefetched else None
+            return job
+        return None
+
+    def get_acl_incident_and_policy(self):
+        job = self.next_buffered_case()
+        if job is None:
+            res = self.session.get(
+                self.next_cases_url(), timeout=self.http_timeout, verify=False
+            )
+            self.buffer_cases(res)
+            job = self.next_buffered_case()
+        return job
+
+    def decision_cache_key(self, incident: str, policy: str):
+        return DecisionCache.key(
+            self.model_digest, preamble, self.engine, incident, policy
+        )
+
+    def cached_decision(self, incident: str, policy: str, caseId: int):
+        if self.decision_cache is None:
+            return None
+        decision = self.decision_cache.get(self.decision_cache_key(incident, policy))
+        if decision is not None:
+            print(f"Using cached decision {decision} for {caseId}", flush=True)
+            print(self.decision_cache.report(), flush=True)
+        return decision
+
+    def cache_decision(self, incident: str, policy: str, decision: str):
+        # Errors may be transient, so only cache actual decisions
+        if self.decision_cache is not None and decision != "error":
+            self.decision_cache.put(self.decision_cache_key(incident, policy), decision)
+
+    def decide(self, incident: str, policy: str, caseId: int) -> str:
+        decision = self.cached_decision(incident, policy, caseId)
+        if decision is not None:
+            return decision
+
+        if self.engine == "score":
+            decision, margin = self.phi.score_incident(incident, policy)
+            print(f"Scored {caseId} as {decision} with margin {margin:.3f}", flush=True)
+        else:
+            decision = self.phi.process_incident(
+                incident, policy, repeats=self.phi_repeats
+            )
+        self.cache_decision(incident, policy, decision)
+        return decision
 
     def process_incident(self, incident: str, policy: str, caseId: int):
-        decision = self.phi.process_incident(incident, policy, repeats=self.phi_repeats)
+        decision = self.decide(incident, policy, caseId)
+        self.post_decision(incident, policy, caseId, decision)
+
+    def post_decision(self, incident: str, policy: str, caseId: int, decision: str):
         # Register decision with ACL app, repeat until successful
         request_url = self.acl_url + f"/app/cases/indexed/{caseId}/decision"
         request_body = {
@@ -140,14 +576,61 @@ class ProcessorDaemon:
             "decision": str(decision),
         }
         print(f"Registering decision with ACL at: {request_url}", flush=True)
-        response = requests.post(
-            request_url, cert=self.cert, json=request_body, verify=False
+        response = self.session.post(
+            request_url, json=request_body, timeout=self.http_timeout, verify=False
         )
         print(response, response.text, flush=True)
         if response.status_code != 200:
             print(f"Failed to register decision for {caseId}", flush=True)
+            return
+        self.record_decision_posted()
+
+    def post_decisions(self, decided):
+        """Posts several (job, decision) pairs in a single ledger transaction,
+        returning the caseIds whose decisions were stored."""
+        request_url = self.acl_url + "/app/cases/decisions/batch"
+        request_body = {
+            "decisions": [
+                {
+                    "caseId": job["caseId"],
+                    "incident": job["incident"],
+                    "policy": job["policy"],
+                    "decision": str(decision),
+                }
+                for job, decision in decided
+            ]
+        }
+        print(
+            f"Registering {len(decided)} decisions with ACL at: {request_url}",
+            flush=True,
+        )
+        response = self.session.post(
+            request_url, json=request_body, timeout=self.http_timeout, verify=False
+        )
+        if response.status_code != 200:
+            print(response, response.text, flush=True)
+            print(
+                f"Failed to register decisions for {[j['caseId'] for j, _ in decided]}",
+                flush=True,
+            )
+            return set()
+
+        stored = set()
+        for result in response.json()["results"]:
+            if result["statusCode"] == 200:
+                stored.add(result["caseId"])
+            else:
+                print(
+                    f"Failed to register decision for {result.get('caseId')}: "
+                    f"{result['statusCode']} {result.get('error')}",
+                    flush=True,
+                )
+        if stored:
+            self.record_decision_posted()
+        return stored
 
     def start_processing(self):
+        self.wait_for_phi()
         while True:
             try:
                 job = self.get_acl_incident_and_policy()
@@ -156,11 +639,327 @@ class ProcessorDaemon:
                 print(e, flush=True)
                 job = None
             if job is None:
-                time.sleep(1)
+                time.sleep(self.backoff.next_delay(self.retry_after))
                 continue
+            self.backoff.reset()
             print(f"Processing {job}", flush=True)
             self.process_incident(job["incident"], job["policy"], job["caseId"])
 
+    def start_pipelined_processing(
+        self,
+        workers=1,
+        queue_depth=4,
+        batch_size=1,
+        report_interval=60,
+        post_batch_size=1,
+    ):
+        self.wait_for_phi()
+        # Cases flow fetcher -> inference workers -> poster, so that polling and
+        # posting to the ledger overlap with inference.
+        jobs = queue.Queue(maxsize=queue_depth)
+        decisions = queue.Queue(maxsize=queue_depth)
+        stats = [StageStats("fetch"), StageStats("inference"), StageStats("post")]
+        fetch_stats, inference_stats, post_stats = stats
+
+        # The ACL re-queues a case until its decision is stored, so cases which are
+        # still in the pipeline must not be fetched again.
+        in_flight = set()
+        in_flight_lock = threading.Lock()
+
+        def fetcher():
+            while True:
+                start = time.perf_counter()
+                try:
+                    job = self.get_acl_incident_and_policy()
+                except Exception as e:
+                    print("Exception while getting job.", flush=True)
+                    print(e, flush=True)
+                    job = None
+                if job is not None:
+                    with in_flight_lock:
+                        if job["caseId"] in in_flight:
+                            job = None
+                        else:
+                            in_flight.add(job["caseId"])
+                if job is None:
+                    time.sleep(self.backoff.next_delay(self.retry_after))
+                    continue
+                self.backoff.reset()
+                fetch_stats.record(time.perf_counter() - start)
+
+                # Cached decisions skip inference altogether
+                decision = self.cached_decision(
+                    job["incident"], job["policy"], job["caseId"]
+                )
+                if decision is not None:
+                    decisions.put((job, decision))
+                else:
+                    jobs.put(job)
+
+        def inference_worker(phi):
+            while True:
+                # Take whatever else is already queued, up to batch_size cases
+                batch = [jobs.get()]
+                while len(batch) < batch_size:
+                    try:
+                        batch.append(jobs.get_nowait())
+                    except queue.Empty:
+                        break
+                # Cases may have waited in the queue until their lease ran out
+                kept = self.drop_expiring(batch)
+                if len(kept) < len(batch):
+                    with in_flight_lock:
+                        in_flight.difference_update(
+                            job["caseId"] for job in batch if job not in kept
+                        )
+                    batch = kept
+                    if not batch:
+                        continue
+                print(f"Processing {batch}", flush=True)
+                start = time.perf_counter()
+                try:
+                    batch_decisions = phi.process_batch(
+                        [(job["incident"], job["policy"]) for job in batch],
+                        repeats=self.phi_repeats,
+                    )
+                except Exception as e:
+                    print(
+                        f"Exception while processing {[j['caseId'] for j in batch]}.",
+                        flush=True,
+                    )
+                    print(e, flush=True)
+                    batch_decisions = ["error"] * len(batch)
+                inference_stats.record(time.perf_counter() - start, len(batch))
+                for job, decision in zip(batch, batch_decisions):
+                    self.cache_decision(job["incident"], job["policy"], decision)
+                    decisions.put((job, decision))
+
+        def poster():
+            while True:
+                # Post whatever else has already been decided together, up to
+                # post_batch_size decisions
+                decided = [decisions.get()]
+                while len(decided) < post_batch_size:
+                    try:
+                        decided.append(decisions.get_nowait())
+                    except queue.Empty:
+                        break
+                case_ids = [job["caseId"] for job, _ in decided]
+                start = time.perf_counter()
+                try:
+                    if len(decided) > 1:
+                        self.post_decisions(decided)
+                    else:
+                        job, decision = decided[0]
+                        self.post_decision(
+                            job["incident"], job["policy"], job["caseId"], decision
+                        )
+                except Exception as e:
+                    print(f"Exception while posting {case_ids}.", flush=True)
+                    print(e, flush=True)
+                post_stats.record(time.perf_counter() - start, len(decided))
+                with in_flight_lock:
+                    in_flight.difference_update(case_ids)
+
+        # Llama contexts are not thread-safe, so each worker owns its own model.
+        # The weights are memory-mapped, so the extra instances share them. An
+        # inference pool dispatches each call to a free worker process instead.
+        if self.inference_processes > 0:
+            phis = [self.phi] * workers
+        else:
+            phis = [self.phi] + [self.create_phi() for _ in range(workers - 1)]
+        threads = [threading.Thread(target=fetcher), threading.Thread(target=poster)]
+        threads += [threading.Thread(target=inference_worker, args=(p,)) for p in phis]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        started = time.perf_counter()
+        while True:
+            time.sleep(report_interval)
+            elapsed = time.perf_counter() - started
+            print(
+                "Pipeline throughput | "
+                + " | ".join(stage.report(elapsed) for stage in stats)
+                + f" | queued {jobs.qsize()} jobs, {decisions.qsize()} decisions",
+                flush=True,
+            )
+            if self.decision_cache is not None:
+                print(self.decision_cache.report(), flush=True)
+            if self.inference_processes > 0:
+                print(self.phi.report(), flush=True)
+
+
+class AsyncProcessorDaemon(ProcessorDaemon):
+    """ProcessorDaemon on asyncio, so that polling, posting decisions and
+    attestation overlap with inference, which runs in an executor. Cases are
+    decided and posted one at a time, by one inference worker, or one per process
+    of an inference pool."""
+
+    async def attest_data(self, report_data: bytes) -> bytes:
+        report = self.attestation_cache.get(report_data)
+        if report is not None:
+            print("Using cached attestation", flush=True)
+            return report
+
+        # The channel is kept for the lifetime of the processor
+        if self.attestation_container is None:
+            print(f"Connecting to attestation sidecar at: {self.uds_sock}", flush=True)
+            channel = grpc.aio.insecure_channel(self.uds_sock)
+            await asyncio.wait_for(channel.channel_ready(), self.attestation_timeout)
+            self.attestation_container = as_grpc.AttestationContainerStub(channel)
+
+        print(f"Getting attestation from: {self.uds_sock}", flush=True)
+        report = await self.attestation_container.FetchAttestation(
+            as_pb.FetchAttestationRequest(report_data=report_data),
+            timeout=self.attestation_timeout,
+        )
+        self.attestation_cache.put(report_data, report, self.cert_expiry)
+        return report
+
+    def create_client(self):
+        self.client = httpx.AsyncClient(
+            verify=self.identity.ssl_context(),
+            timeout=self.http_timeout,
+            limits=httpx.Limits(
+                max_connections=self.http_pool_size,
+                max_keepalive_connections=self.http_pool_size,
+            ),
+        )
+
+    async def setup_acl(self):
+        self.create_client()
+
+        print("Pinning acl service certificate", flush=True)
+        res = await self.client.get("https://" + self.raw_acl_url + "/node/network")
+        if res.status_code != 200:
+            print(res, res.text, flush=True)
+            raise ValueError(
+                "Unable to set up connection to ACL. Perhaps the app has not been loaded?"
+            )
+        # The PEM of the service certificate, which ssl contexts take as cadata
+        self.acl_ca = res.json()["service_certificate"]
+
+        if self.verify_fingerprint:
+            print("Checking ccf_format certificate fingerprint", flush=True)
+            self.check_fingerprint(
+                await self.client.get(self.acl_url + "/app/ccf-cert")
+            )
+
+        with self.timeline.phase("attestation"):
+            attest_report = await self.attest_data(
+                hashlib.sha256(self.fingerprint.encode("utf-8")).digest()
+            )
+
+        payload = registration_payload(attest_report)
+        register_url = self.acl_url + "/app/processor"
+        print(f"Registering with ACL at: {register_url}", flush=True)
+        with self.timeline.phase("registration"):
+            response = await self.client.put(register_url, json=payload)
+        if response.status_code != 200:
+            print("Failed to register with ACL. Exiting now", flush=True)
+            print(response, response.text, flush=True)
+            exit(-1)
+
+        print("Successfully registered with ACL", flush=True)
+
+    async def get_acl_incident_and_policy(self):
+        job = self.next_buffered_case()
+        if job is None:
+            res = await self.client.get(self.next_cases_url())
+            self.buffer_cases(res)
+            job = self.next_buffered_case()
+        return job
+
+    async def post_decision(
+        self, incident: str, policy: str, caseId: int, decision: str
+    ):
+        request_url = self.acl_url + f"/app/cases/indexed/{caseId}/decision"
+        request_body = {
+            "incident": incident,
+            "policy": policy,
+            "decision": str(decision),
+        }
+        print(f"Registering decision with ACL at: {request_url}", flush=True)
+        try:
+            response = await self.client.post(request_url, json=request_body)
+        except Exception as e:
+            print(f"Exception while posting {caseId}.", flush=True)
+            print(e, flush=True)
+            return
+        print(response, response.text, flush=True)
+        if response.status_code != 200:
+            print(f"Failed to register decision for {caseId}", flush=True)
+            return
+        self.record_decision_posted()
+
+    async def start_processing(self, queue_depth=4):
+        await asyncio.get_running_loop().run_in_executor(None, self.wait_for_phi)
+        # Llama contexts are not thread-safe, so inference runs on one thread,
+        # or one per process of an inference pool
+        inference_threads = max(1, self.inference_processes)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=inference_threads)
+        jobs = asyncio.Queue(maxsize=queue_depth)
+        # The ACL re-queues a case until its decision is stored, so cases which are
+        # still being processed must not be fetched again.
+        in_flight = set()
+        posting = set()
+
+        async def fetcher():
+            while True:
+                try:
+                    job = await self.get_acl_incident_and_policy()
+                except Exception as e:
+                    print("Exception while getting job.", flush=True)
+                    print(e, flush=True)
+                    job = None
+                if job is None or job["caseId"] in in_flight:
+                    await asyncio.sleep(self.backoff.next_delay(self.retry_after))
+                    continue
+                self.backoff.reset()
+                in_flight.add(job["caseId"])
+                await jobs.put(job)
+
+        async def post(job, decision):
+            try:
+                await self.post_decision(
+                    job["incident"], job["policy"], job["caseId"], decision
+                )
+            finally:
+                in_flight.discard(job["caseId"])
+
+        async def worker():
+            loop = asyncio.get_running_loop()
+            while True:
+                job = await jobs.get()
+                # The case may have waited in the queue until its lease ran out
+                if not self.drop_expiring([job]):
+                    in_flight.discard(job["caseId"])
+                    continue
+                print(f"Processing {job}", flush=True)
+                try:
+                    decision = await loop.run_in_executor(
+                        executor,
+                        self.decide,
+                        job["incident"],
+                        job["policy"],
+                        job["caseId"],
+                    )
+                except Exception as e:
+                    print(f"Exception while processing {job['caseId']}.", flush=True)
+                    print(e, flush=True)
+                    decision = "error"
+                # Posting carries on while the next case is processed
+                task = asyncio.create_task(post(job, decision))
+                posting.add(task)
+                task.add_done_callback(posting.discard)
+
+        await asyncio.gather(fetcher(), *[worker() for _ in range(inference_threads)])
+
+    async def run(self, queue_depth=4):
+        await self.setup_acl()
+        await self.start_processing(queue_depth)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -176,6 +975,49 @@ if __name__ == "__main__":
         default="/mnt/uds/sock",
         help="Path to unix domain socket for attestation side-car",
     )
+    parser.add_argument(
+        "--attestation-timeout",
+        type=float,
+        default=10.0,
+        help="Seconds to wait for the attestation side-car to respond.",
+    )
+    parser.add_argument(
+        "--attestation-cache-dir",
+        type=str,
+        default=None,
+        help="Directory to keep attestation reports in, so that re-registering "
+        "with the same key does not fetch a new report. Only useful with "
+        "--credential-root, as ephemeral keys differ on every start.",
+    )
+    parser.add_argument(
+        "--credential-root",
+        type=str,
+        default=os.environ.get("PROCESSOR_CREDENTIAL_ROOT"),
+        help="Path prefix to store the processor's key and certificate at, so that "
+        "they are kept across restarts until the certificate expires, rather than "
+        "generating an ephemeral key on every start.",
+    )
+    parser.add_argument(
+        "--key-algorithm",
+        choices=list(identity.key_algorithms),
+        default=os.environ.get("PROCESSOR_KEY_ALGORITHM", "rsa-2048"),
+        help="Algorithm of the processor's ephemeral key. EC keys are generated "
+        "far faster than RSA keys.",
+    )
+    parser.add_argument(
+        "--key-pool-dir",
+        type=str,
+        default=os.environ.get("PROCESSOR_KEY_POOL_DIR"),
+        help="Directory of pregenerated keys to take the processor's key from, "
+        "which is refilled in the background.",
+    )
+    parser.add_argument(
+        "--verify-fingerprint",
+        action=argparse.BooleanOptionalAction,
+        default=env_flag("PROCESSOR_VERIFY_FINGERPRINT", False),
+        help="Check the certificate fingerprint, which is computed locally, against "
+        "the ACL's /app/ccf-cert before registering.",
+    )
     parser.add_argument(
         "--repeats",
         type=int,
@@ -187,12 +1029,233 @@ if __name__ == "__main__":
         action="store_true",
         help="Run a test prompt through phi to remove load time from execution.",
     )
+    parser.add_argument(
+        "--auto-tune",
+        action=argparse.BooleanOptionalAction,
+        default=env_flag("PHI_AUTO_TUNE", False),
+        help="Time the test prompt with a few thread counts at startup and use the "
+        "fastest. Implies --prime-phi.",
+    )
+    parser.add_argument(
+        "--n-ctx",
+        type=int,
+        default=os.environ.get("PHI_N_CTX", "1024"),
+        help="Context size of the model.",
+    )
+    parser.add_argument(
+        "--n-threads",
+        type=int,
+        default=os.environ.get("PHI_N_THREADS"),
+        help="Threads used for inference. Defaults to llama.cpp's choice.",
+    )
+    parser.add_argument(
+        "--n-batch",
+        type=int,
+        default=os.environ.get("PHI_N_BATCH", "512"),
+        help="Maximum number of prompt tokens evaluated at once.",
+    )
+    parser.add_argument(
+        "--mmap",
+        action=argparse.BooleanOptionalAction,
+        default=env_flag("PHI_USE_MMAP", True),
+        help="Memory-map the model rather than reading it into memory.",
+    )
+    parser.add_argument(
+        "--mlock",
+        action=argparse.BooleanOptionalAction,
+        default=env_flag("PHI_USE_MLOCK", False),
+        help="Lock the model in memory so it cannot be swapped out.",
+    )
+    parser.add_argument(
+        "--cache-type-k",
+        choices=list(kv_cache_types),
+        default=os.environ.get("PHI_CACHE_TYPE_K"),
+        help="Type of the KV cache keys. Defaults to f16.",
+    )
+    parser.add_argument(
+        "--cache-type-v",
+        choices=list(kv_cache_types),
+        default=os.environ.get("PHI_CACHE_TYPE_V"),
+        help="Type of the KV cache values. Quantized types need --flash-attn.",
+    )
+    parser.add_argument(
+        "--flash-attn",
+        action=argparse.BooleanOptionalAction,
+        default=env_flag("PHI_FLASH_ATTN", False),
+        help="Use flash attention.",
+    )
+    parser.add_argument(
+        "--inference-processes",
+        type=int,
+        default=0,
+        help="Number of worker processes to run inference in, sharing the "
+        "memory-mapped model. Implies a pipeline with as many --workers.",
+    )
+    parser.add_argument(
+        "--persist-prefix-cache",
+        action="store_true",
+        help="Save the evaluated preamble state next to the model and reuse it on restart.",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["generate", "grammar", "score"],
+        default="generate",
+        help="How Phi produces a decision: free text generation which is parsed and "
+        "retried, generation constrained by a grammar to the valid decisions, or "
+        "comparing the likelihood of each decision in a single evaluation.",
+    )
+    parser.add_argument(
+        "--decision-cache-size",
+        type=int,
+        default=0,
+        help="Number of decisions to cache for repeated incident and policy pairs. "
+        "Disabled if 0.",
+    )
+    parser.add_argument(
+        "--decision-cache-path",
+        type=str,
+        default=None,
+        help="File to persist the decision cache to, so it survives restarts.",
+    )
+    parser.add_argument(
+        "--http-pool-size",
+        type=int,
+        default=4,
+        help="Maximum number of kept-alive connections to the ACL.",
+    )
+    parser.add_argument(
+        "--http-timeout",
+        type=float,
+        default=30,
+        help="Timeout in seconds for requests to the ACL.",
+    )
+    parser.add_argument(
+        "--min-poll-interval",
+        type=float,
+        default=0.1,
+        help="Seconds to wait before polling again after the first empty poll.",
+    )
+    parser.add_argument(
+        "--max-poll-interval",
+        type=float,
+        default=10.0,
+        help="Cap in seconds on the backoff between polls while there are no cases.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of inference workers, each with its own model. "
+        "If set, fetching, inference and posting decisions run as a pipeline.",
+    )
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=4,
+        help="Maximum number of cases waiting between pipeline stages.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Maximum number of queued cases an inference worker decides at once.",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=1,
+        help="Number of cases to fetch and lease in a single request, handing them "
+        "out one at a time before fetching more.",
+    )
+    parser.add_argument(
+        "--lease-margin",
+        type=float,
+        default=30.0,
+        help="Seconds before a case's lease expires at which it is dropped instead "
+        "of decided, as the ACL may hand it to another processor. Prefetching "
+        "leases no more cases than are handed out before then.",
+    )
+    parser.add_argument(
+        "--post-batch-size",
+        type=int,
+        default=1,
+        help="Maximum number of decided cases the pipeline posts to the ACL in a "
+        "single request.",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Run the processor on asyncio, overlapping requests to the ACL and "
+        "the attestation sidecar with inference.",
+    )
     args = parser.parse_args()
-
-    processor = ProcessorDaemon(args.uds_sock, args.acl_url, phi_repeats=args.repeats)
-    processor.setup_acl()
-    if args.prime_phi:
-        processor.phi.process_incident(
-            "The policyholder hit a car", "This policy approves all claims."
+    if args.use_async:
+        # The asyncio processor has its own inference workers and posts decisions
+        # one at a time
+        for flag, value, default in [
+            ("--workers", args.workers, 0),
+            ("--batch-size", args.batch_size, 1),
+            ("--post-batch-size", args.post_batch_size, 1),
+        ]:
+            if value != default:
+                parser.error(
+                    f"{flag} is not supported with --async, which runs one inference "
+                    "worker per --inference-processes"
+                )
+    if args.auto_tune and args.inference_processes > 0:
+        parser.error(
+            "--auto-tune is not supported with --inference-processes, "
+            "set --n-threads instead"
         )
-    processor.start_processing()
+
+    daemon_class = AsyncProcessorDaemon if args.use_async else ProcessorDaemon
+    processor = daemon_class(
+        args.uds_sock,
+        args.acl_url,
+        phi_repeats=args.repeats,
+        persist_prefix_cache=args.persist_prefix_cache,
+        engine=args.engine,
+        decision_cache_size=args.decision_cache_size,
+        decision_cache_path=args.decision_cache_path,
+        http_pool_size=args.http_pool_size,
+        http_timeout=args.http_timeout,
+        min_poll_interval=args.min_poll_interval,
+        max_poll_interval=args.max_poll_interval,
+        attestation_timeout=args.attestation_timeout,
+        attestation_cache_dir=args.attestation_cache_dir,
+        phi_options={
+            "n_ctx": args.n_ctx,
+            "n_threads": args.n_threads,
+            "n_batch": args.n_batch,
+            "use_mmap": args.mmap,
+            "use_mlock": args.mlock,
+            "type_k": args.cache_type_k,
+            "type_v": args.cache_type_v,
+            "flash_attn": args.flash_attn,
+        },
+        prime_phi=args.prime_phi,
+        auto_tune=args.auto_tune,
+        inference_processes=args.inference_processes,
+        prefetch=args.prefetch,
+        lease_margin=args.lease_margin,
+        key_algorithm=args.key_algorithm,
+        key_pool_dir=args.key_pool_dir,
+        verify_fingerprint=args.verify_fingerprint,
+        credential_root=args.credential_root,
+    )
+    if args.use_async:
+        asyncio.run(processor.run(args.queue_depth))
+    else:
+        processor.setup_acl()
+        # Each pipeline worker keeps one inference process busy
+        workers = max(args.workers, args.inference_processes)
+        if workers > 0:
+            processor.start_pipelined_processing(
+                workers,
+                args.queue_depth,
+                args.batch_size,
+                post_batch_size=args.post_batch_size,
+            )
+        else:
+            processor.start_processing()
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import attestation_service_pb2 as as_pb
+
+
+class AttestationCache:
+    """Attestation reports from the sidecar keyed by their report_data, each valid
+    until the certificate it attests expires. Optionally persisted to a directory,
+    so a restarted processor with the same key does not need a new report."""
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.reports = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.prune()
+
+    def prune(self):
+        """Removes stored reports which have expired, or cannot be read, as those
+        for a key which is no longer used are never looked up again."""
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, "r") as report_file:
+                    expired = json.load(report_file)["expiry"] <= time.time()
+            except (OSError, ValueError, KeyError, TypeError):
+                expired = True
+            if expired:
+                os.remove(path)
+
+    def path(self, report_data):
+        return os.path.join(
+            self.directory, hashlib.sha256(report_data).hexdigest() + ".json"
+        )
+
+    def get(self, report_data):
+        with self.lock:
+            entry = self.reports.get(report_data)
+        if entry is None and self.directory and os.path.isfile(self.path(report_data)):
+            with open(self.path(report_data), "r") as report_file:
+                stored = json.load(report_file)
+            entry = (
+                as_pb.FetchAttestationReply.FromString(bytes.fromhex(stored["report"])),
+                stored["expiry"],
+            )
+        if entry is None:
+            return None
+
+        report, expiry = entry
+        if time.time() >= expiry:
+            self.evict(report_data)
+            return None
+        with self.lock:
+            self.reports[report_data] = entry
+        return report
+
+    def put(self, report_data, report, expiry):
+        with self.lock:
+            self.reports[report_data] = (report, expiry)
+        if self.directory:
+            with open(self.path(report_data), "w") as report_file:
+                json.dump(
+                    {"report": report.SerializeToString().hex(), "expiry": expiry},
+                    report_file,
+                )
+
+    def evict(self, report_data):
+        with self.lock:
+            self.reports.pop(report_data, None)
+        if self.directory and os.path.isfile(self.path(report_data)):
+            os.remove(self.path(report_data))
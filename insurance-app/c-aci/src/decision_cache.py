@@ -0,0 +1,91 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
+
+class DecisionCache:
+    """LRU cache of decisions, keyed by a digest of everything which determines
+    the decision, optionally persisted to an append-only log of JSON lines."""
+
+    def __init__(self, max_size, path=None):
+        self.max_size = max_size
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.log = None
+        self.logged = 0
+
+        if path:
+            if os.path.isfile(path):
+                self.load()
+                print(f"Loaded {len(self.entries)} cached decisions from {path}")
+            self.compact()
+
+    def load(self):
+        with open(self.path, "r") as cache_file:
+            for line in cache_file:
+                try:
+                    key, decision = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash, or a cache saved as one list
+                    # by an earlier version
+                    continue
+                if isinstance(key, str):
+                    self.entries[key] = decision
+                    self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            decision = self.entries.get(key)
+            if decision is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return decision
+
+    def put(self, key, decision):
+        with self.lock:
+            self.entries[key] = decision
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            if self.log is not None:
+                self.log.write(json.dumps([key, decision]) + "\n")
+                self.log.flush()
+                self.logged += 1
+                # Evicted entries are only dropped from the log when it is
+                # rewritten, which is rare enough to cost O(1) per put on average
+                if self.logged > 2 * self.max_size:
+                    self.compact()
+
+    def compact(self):
+        """Rewrites the log with just the cached entries, oldest first."""
+        if self.log is not None:
+            self.log.close()
+        # Write then rename, so a crash never leaves a truncated cache behind
+        with open(self.path + ".tmp", "w") as cache_file:
+            for key, decision in self.entries.items():
+                cache_file.write(json.dumps([key, decision]) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+        self.log = open(self.path, "a")
+        self.logged = len(self.entries)
+
+    def report(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            hit_rate = self.hits / lookups if lookups else 0.0
+            return (
+                f"decision cache: {len(self.entries)}/{self.max_size} entries, "
+                f"{self.hits} hits, {self.misses} misses ({hit_rate:.0%} hit rate)"
+            )
@@ -0,0 +1,35 @@
+import hashlib
+import json
+import os
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_file_digest(path):
+    """file_digest of path, memoized in a file next to it by the size and
+    modification time of path, as hashing a multi-GB model takes a while."""
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    digest_path = path + ".sha256"
+    try:
+        with open(digest_path, "r") as digest_file:
+            stored = json.load(digest_file)
+        if stored["stamp"] == stamp:
+            return stored["digest"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    digest = file_digest(path)
+    try:
+        with open(digest_path, "w") as digest_file:
+            json.dump({"stamp": stamp, "digest": digest}, digest_file)
+    except OSError:
+        # e.g. a read-only model directory, so it is hashed again next time
+        pass
+    return digest
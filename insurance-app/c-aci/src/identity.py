@@ -0,0 +1,339 @@
+# Adapted from CCF infrastructure
+
+import atexit
+import datetime
+from typing import Tuple
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+from cryptography.hazmat.primitives.serialization import (
+    load_pem_private_key,
+    Encoding,
+    PrivateFormat,
+    PublicFormat,
+    NoEncryption,
+)
+from cryptography.x509.oid import NameOID
+
+import os
+import shutil
+import ssl
+import tempfile
+import threading
+import time
+import uuid
+
+_RECOMMENDED_RSA_PUBLIC_EXPONENT = 65537
+
+
+def generate_rsa_keypair(key_size: int) -> Tuple[str, str]:
+    """Generates an RSA keypair, returning a Tuple of (pprivate key, public key)."""
+
+    priv = rsa.generate_private_key(
+        public_exponent=_RECOMMENDED_RSA_PUBLIC_EXPONENT,
+        key_size=key_size,
+        backend=default_backend(),
+    )
+    pub = priv.public_key()
+    priv_pem = priv.private_bytes(
+        Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()
+    ).decode("ascii")
+    pub_pem = pub.public_bytes(Encoding.PEM, PublicFormat.SubjectPublicKeyInfo).decode(
+        "ascii"
+    )
+    return priv_pem, pub_pem
+
+
+def generate_ec_keypair(curve: ec.EllipticCurve) -> Tuple[str, str]:
+    """Generates an EC keypair, returning a Tuple of (private key, public key)."""
+
+    priv = ec.generate_private_key(curve, backend=default_backend())
+    pub = priv.public_key()
+    priv_pem = priv.private_bytes(
+        Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()
+    ).decode("ascii")
+    pub_pem = pub.public_bytes(Encoding.PEM, PublicFormat.SubjectPublicKeyInfo).decode(
+        "ascii"
+    )
+    return priv_pem, pub_pem
+
+
+def generate_ed25519_keypair() -> Tuple[str, str]:
+    """Generates an Ed25519 keypair, returning a Tuple of (private key, public key)."""
+
+    priv = ed25519.Ed25519PrivateKey.generate()
+    pub = priv.public_key()
+    priv_pem = priv.private_bytes(
+        Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()
+    ).decode("ascii")
+    pub_pem = pub.public_bytes(Encoding.PEM, PublicFormat.SubjectPublicKeyInfo).decode(
+        "ascii"
+    )
+    return priv_pem, pub_pem
+
+
+# RSA is the slowest to generate by far. Not every ledger accepts Ed25519
+# certificates.
+key_algorithms = {
+    "rsa-2048": lambda: generate_rsa_keypair(2048),
+    "ec-p256": lambda: generate_ec_keypair(ec.SECP256R1()),
+    "ec-p384": lambda: generate_ec_keypair(ec.SECP384R1()),
+    "ed25519": generate_ed25519_keypair,
+}
+
+
+def generate_cert(
+    priv_key_pem: str, cn: str = "dummy"  # pylint: disable=invalid-name
+) -> str:
+    priv = load_pem_private_key(priv_key_pem.encode("ascii"), None, default_backend())
+    pub = priv.public_key()
+    subject = issuer = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)])
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(issuer)
+        .public_key(pub)
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(datetime.datetime.utcnow())
+        .not_valid_after(datetime.datetime.utcnow() + datetime.timedelta(days=10))
+        .sign(
+            priv,
+            # Ed25519 signatures have their hash built in
+            None if isinstance(priv, ed25519.Ed25519PrivateKey) else hashes.SHA256(),
+            default_backend(),
+        )
+    )
+
+    return cert.public_bytes(Encoding.PEM).decode("ascii")
+
+
+def check_key_algorithm(algorithm: str):
+    if algorithm not in key_algorithms:
+        raise ValueError(
+            f"Unknown key algorithm {algorithm}, expected one of "
+            f"{', '.join(key_algorithms)}"
+        )
+
+
+def generate_identity(algorithm: str = "rsa-2048") -> Tuple[str, str]:
+    """Generates a private key and a self-signed certificate for it, returning a
+    Tuple of (private key, certificate)."""
+    check_key_algorithm(algorithm)
+    privk_pem_str, _ = key_algorithms[algorithm]()
+    return privk_pem_str, generate_cert(privk_pem_str)
+
+
+class KeyPool:
+    """Keeps up to size ready key and certificate pairs of one algorithm in
+    directory, generating more in a background thread whenever one is taken, so
+    that ephemeral identities do not wait for key generation. Pairs are claimed
+    by renaming their directory, so processes sharing a pool never get the same
+    pair, and pairs older than max_age are discarded rather than handed out."""
+
+    def __init__(
+        self,
+        directory,
+        algorithm="rsa-2048",
+        size=4,
+        max_age=datetime.timedelta(days=1),
+    ):
+        check_key_algorithm(algorithm)
+        self.directory = directory
+        self.algorithm = algorithm
+        self.size = size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.refill_thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def ready_entries(self):
+        prefix = f"ready-{self.algorithm}-"
+        return sorted(e for e in os.listdir(self.directory) if e.startswith(prefix))
+
+    @staticmethod
+    def entry_paths(entry):
+        return os.path.join(entry, "privk.pem"), os.path.join(entry, "cert.pem")
+
+    def write_entry(self, entry):
+        privk_pem_str, cert_pem_str = generate_identity(self.algorithm)
+        os.makedirs(entry)
+        keypath, certpath = self.entry_paths(entry)
+        with open(keypath, "w") as keyfile, open(certpath, "w") as certfile:
+            keyfile.write(privk_pem_str)
+            certfile.write(cert_pem_str)
+        return keypath, certpath
+
+    def add(self):
+        # Written under a temporary name, so a pair is only taken once complete
+        name = f"{self.algorithm}-{uuid.uuid4().hex}"
+        self.write_entry(os.path.join(self.directory, f"tmp-{name}"))
+        os.rename(
+            os.path.join(self.directory, f"tmp-{name}"),
+            os.path.join(self.directory, f"ready-{name}"),
+        )
+
+    def fill(self):
+        # Pairs left half written by a process which exited while filling
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith("tmp-") and time.time() - os.path.getmtime(path) > 3600:
+                shutil.rmtree(path, ignore_errors=True)
+        while len(self.ready_entries()) < self.size:
+            self.add()
+
+    def refill_in_background(self):
+        with self.lock:
+            if self.refill_thread is None or not self.refill_thread.is_alive():
+                self.refill_thread = threading.Thread(target=self.fill, daemon=True)
+                self.refill_thread.start()
+
+    def take(self) -> "Identity":
+        """Claims a ready pair, or generates one if none are ready. The claimed pair
+        is read into memory and removed from the pool directory."""
+        for name in self.ready_entries():
+            claimed = os.path.join(self.directory, "claimed-" + name[len("ready-") :])
+            try:
+                os.rename(os.path.join(self.directory, name), claimed)
+            except FileNotFoundError:
+                # Claimed by another process
+                continue
+            keypath, certpath = self.entry_paths(claimed)
+            try:
+                if (
+                    time.time() - os.path.getmtime(certpath)
+                    > self.max_age.total_seconds()
+                ):
+                    continue
+                self.refill_in_background()
+                with open(keypath, "r") as keyfile, open(certpath, "r") as certfile:
+                    return Identity(keyfile.read(), certfile.read())
+            finally:
+                shutil.rmtree(claimed, ignore_errors=True)
+
+        self.refill_in_background()
+        return Identity.generate(self.algorithm)
+
+
+def load_identity(credential_root=None, algorithm="rsa-2048", key_pool=None):
+    """Reads the identity stored at credential_root, creating and storing it if it
+    does not exist yet. Without a credential_root, returns an ephemeral identity
+    which is only held in memory."""
+    if credential_root is None:
+        # Take an ephemeral key from the pool, which has its own algorithm
+        if key_pool is not None:
+            print("Using pooled ephemeral credentials")
+            return key_pool.take()
+        print("Using ephemeral credentials")
+        return Identity.generate(algorithm)
+
+    keypath = f"{credential_root}.privk.pem"
+    certpath = f"{credential_root}.cert.pem"
+    # Written by earlier versions of the processor
+    if not os.path.isfile(certpath) and os.path.isfile(
+        f"{credential_root}.certpath.pem"
+    ):
+        certpath = f"{credential_root}.certpath.pem"
+
+    # Files exist so just use them, unless the certificate has expired
+    if os.path.isfile(keypath) and os.path.isfile(certpath):
+        identity = Identity.from_files(certpath, keypath)
+        if identity.expiry > time.time():
+            print("Using stored credentials")
+            return identity
+        print("Stored credentials have expired")
+
+    # Files don't exist so write to them
+    print("Creating new credentials")
+    identity = Identity.generate(algorithm)
+    identity.write(certpath, keypath)
+    return identity
+
+
+def format_cert_fingerprint(hex_string):
+    # Convert to uppercase
+    hex_string = hex_string.upper()
+    # Split into pairs of two characters and join with a colon
+    formatted_fingerprint = ":".join(
+        hex_string[i : i + 2] for i in range(0, len(hex_string), 2)
+    )
+    return formatted_fingerprint
+
+
+class Identity:
+    """A private key and its certificate, held in memory. Files are only written
+    to persist the identity, or for clients which only load certificates from
+    files."""
+
+    def __init__(self, key_pem: str, cert_pem: str):
+        if not key_pem:
+            raise ValueError("Key file is empty or improperly formatted.")
+        if not cert_pem:
+            raise ValueError("Cert file is empty or improperly formatted.")
+        self.key_pem = key_pem
+        self.cert_pem = cert_pem
+        self.key = load_pem_private_key(key_pem.encode("ascii"), None)
+        self.cert = x509.load_pem_x509_certificate(cert_pem.encode("ascii"))
+        self.cert_der = self.cert.public_bytes(Encoding.DER)
+        # Hex SHA-256 of the DER certificate, and the same in the format the ACL
+        # identifies users and processors by
+        self.fingerprint = self.cert.fingerprint(hashes.SHA256()).hex()
+        self.acl_fingerprint = format_cert_fingerprint(self.fingerprint)
+        self.expiry = self.cert.not_valid_after_utc.timestamp()
+        self.paths = None
+
+    @classmethod
+    def generate(cls, algorithm: str = "rsa-2048"):
+        return cls(*generate_identity(algorithm))
+
+    @classmethod
+    def from_files(cls, certpath: str, keypath: str):
+        with open(keypath, "r") as key_file, open(certpath, "r") as cert_file:
+            identity = cls(key_file.read(), cert_file.read())
+        identity.paths = (certpath, keypath)
+        return identity
+
+    def write_files(self, certpath: str, keypath: str):
+        with open(keypath, "w") as keyfile, open(certpath, "w") as certfile:
+            keyfile.write(self.key_pem)
+            certfile.write(self.cert_pem)
+
+    def write(self, certpath: str, keypath: str):
+        """Persists the identity, which from then on is loaded from these files."""
+        self.write_files(certpath, keypath)
+        self.paths = (certpath, keypath)
+
+    def cert_files(self) -> Tuple[str, str]:
+        """Returns (certpath, keypath) for clients which only load certificates from
+        files. Unless the identity was persisted, they are written to a private
+        temporary directory which is removed when the process exits."""
+        if self.paths is None:
+            directory = tempfile.mkdtemp(prefix="identity-")
+            atexit.register(shutil.rmtree, directory, ignore_errors=True)
+            self.write(
+                os.path.join(directory, "cert.pem"),
+                os.path.join(directory, "privk.pem"),
+            )
+        return self.paths
+
+    def ssl_context(self, server=False) -> ssl.SSLContext:
+        """An SSL context presenting the identity as a client certificate, which
+        like verify=False does not verify the server, or as a server certificate."""
+        if server:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        else:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if self.paths is not None:
+            context.load_cert_chain(*self.paths)
+            return context
+        # The ssl module only loads certificates from files, so they only exist
+        # until they are loaded
+        with tempfile.TemporaryDirectory(prefix="identity-") as directory:
+            certpath = os.path.join(directory, "cert.pem")
+            keypath = os.path.join(directory, "privk.pem")
+            self.write_files(certpath, keypath)
+            context.load_cert_chain(certpath, keypath)
+        return context
@@ -0,0 +1,133 @@
+import concurrent.futures
+import multiprocessing
+import os
+import queue
+import threading
+
+from phi import Phi
+
+# The Phi instance of a worker process
+worker_phi = None
+
+
+def memory_usage():
+    """Resident memory of this process in MB. RssFile is mostly the memory-mapped
+    model, which is shared with every other process mapping it, so Pss (which
+    splits shared pages between the processes sharing them) is the actual cost."""
+    usage = {"pid": os.getpid()}
+    with open("/proc/self/status", "r") as status:
+        for line in status:
+            key, value = line.split(":", 1)
+            if key in {"VmRSS", "RssAnon", "RssFile"}:
+                usage[key] = int(value.split()[0]) / 1024
+    if os.path.isfile("/proc/self/smaps_rollup"):
+        with open("/proc/self/smaps_rollup", "r") as rollup:
+            for line in rollup:
+                if line.startswith("Pss:"):
+                    usage["Pss"] = int(line.split()[1]) / 1024
+    return usage
+
+
+def init_worker(model_path, phi_kwargs, prime, ready):
+    global worker_phi
+    try:
+        worker_phi = Phi(model_path, **phi_kwargs)
+        if prime:
+            worker_phi.process_incident(
+                "The policyholder hit a car", "This policy approves all claims."
+            )
+    except Exception as e:
+        # Passed to the parent, which would otherwise only see a broken pool
+        ready.put(e)
+        raise
+    ready.put(memory_usage())
+
+
+def call_worker(method, *args, **kwargs):
+    return getattr(worker_phi, method)(*args, **kwargs), memory_usage()
+
+
+class InferencePool:
+    """Decides cases in worker processes, each with its own Phi, behind the same
+    interface as Phi. Every worker memory-maps the model read-only, so the weights
+    are shared through the page cache rather than copied into each process."""
+
+    def __init__(self, processes, model_path, phi_kwargs=None, prime=False):
+        self.processes = processes
+        self.lock = threading.Lock()
+        self.usage = {}
+
+        # Workers are spawned rather than forked, as the llama.cpp and gRPC threads
+        # of the parent do not survive a fork.
+        context = multiprocessing.get_context("spawn")
+        ready = context.Queue()
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            processes,
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(model_path, dict(phi_kwargs or {}), prime, ready),
+        )
+        # Workers only start when there is work, so submit a trivial call to each
+        # and wait for all of them to load the model.
+        futures = [self.executor.submit(os.getpid) for _ in range(processes)]
+        try:
+            self.wait_for_workers(processes, ready, futures)
+        except BaseException:
+            self.shutdown()
+            raise
+        print(self.report(), flush=True)
+
+    def wait_for_workers(self, processes, ready, futures):
+        started = 0
+        while started < processes:
+            try:
+                usage = ready.get(timeout=1)
+            except queue.Empty:
+                # A worker killed while loading, e.g. out of memory, breaks the
+                # pool without reporting anything
+                for future in futures:
+                    if future.done() and future.exception() is not None:
+                        raise future.exception()
+                continue
+            if isinstance(usage, Exception):
+                raise usage
+            self.record_usage(usage)
+            started += 1
+
+    def record_usage(self, usage):
+        with self.lock:
+            self.usage[usage["pid"]] = usage
+
+    def call(self, method, *args, **kwargs):
+        result, usage = self.executor.submit(
+            call_worker, method, *args, **kwargs
+        ).result()
+        self.record_usage(usage)
+        return result
+
+    def process_incident(self, incident, policy, repeats=1):
+        return self.call("process_incident", incident, policy, repeats=repeats)
+
+    def process_batch(self, cases, repeats=1):
+        return self.call("process_batch", cases, repeats=repeats)
+
+    def score_incident(self, incident, policy):
+        return self.call("score_incident", incident, policy)
+
+    def report(self):
+        with self.lock:
+            usage = sorted(self.usage.values(), key=lambda u: u["pid"])
+        lines = [
+            f"  worker {u['pid']}: "
+            + ", ".join(f"{key} {u[key]:.0f}MB" for key in u if key != "pid")
+            for u in usage
+        ]
+        totals = {key: sum(u.get(key, 0) for u in usage) for key in ["VmRSS", "Pss"]}
+        return (
+            f"Inference pool memory, {len(usage)} workers | total RSS "
+            f"{totals['VmRSS']:.0f}MB, total PSS {totals['Pss']:.0f}MB\n"
+            + "\n".join(lines)
+        )
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import re
+
+import gguf
+import numpy as np
+
+from phi import preamble
+
+# Phi-3's chat tokens, so that prompts tokenize into the same structure
+special_tokens = ["<|system|>", "<|user|>", "<|assistant|>", "<|end|>"]
+
+
+def build_vocab(texts):
+    """A sentencepiece style vocabulary which tokenizes texts into roughly one token
+    per word, falling back to bytes for anything else."""
+    tokens = ["<unk>", "<s>", "</s>"]
+    types = [
+        gguf.TokenType.UNKNOWN,
+        gguf.TokenType.CONTROL,
+        gguf.TokenType.CONTROL,
+    ]
+    tokens += special_tokens
+    types += [gguf.TokenType.CONTROL] * len(special_tokens)
+    tokens += [f"<0x{byte:02X}>" for byte in range(256)]
+    types += [gguf.TokenType.BYTE] * 256
+
+    # Every prefix of a word is a token, so words are built up one merge at a time
+    pieces = {}
+    for text in texts:
+        for piece in re.findall(r" ?\w+| ?[^\w\s]|\s", text):
+            piece = piece.replace(" ", "▁")
+            for end in range(1, len(piece) + 1):
+                pieces.setdefault(piece[:end], len(pieces))
+    for piece in sorted(pieces, key=pieces.get):
+        if piece not in tokens:
+            tokens.append(piece)
+            types.append(gguf.TokenType.NORMAL)
+
+    # Longer pieces score higher, so the tokenizer prefers whole words
+    scores = [
+        float(len(token)) if t == gguf.TokenType.NORMAL else 0.0
+        for token, t in zip(tokens, types)
+    ]
+    return tokens, scores, types
+
+
+def write_model(path, texts, n_embd, n_layer, n_head, n_ff, n_ctx, seed):
+    tokens, scores, types = build_vocab(texts)
+    rng = np.random.default_rng(seed)
+
+    def weight(*shape):
+        return rng.normal(0, 0.02, shape).astype(np.float32)
+
+    def norm():
+        return np.ones(n_embd, dtype=np.float32)
+
+    writer = gguf.GGUFWriter(path, "llama")
+    writer.add_name("tiny-phi-test")
+    writer.add_context_length(n_ctx)
+    writer.add_embedding_length(n_embd)
+    writer.add_block_count(n_layer)
+    writer.add_feed_forward_length(n_ff)
+    writer.add_head_count(n_head)
+    writer.add_head_count_kv(n_head)
+    writer.add_rope_dimension_count(n_embd // n_head)
+    writer.add_layer_norm_rms_eps(1e-5)
+    writer.add_file_type(gguf.LlamaFileType.ALL_F32)
+
+    writer.add_tokenizer_model("llama")
+    writer.add_token_list(tokens)
+    writer.add_token_scores(scores)
+    writer.add_token_types(types)
+    writer.add_unk_token_id(0)
+    writer.add_bos_token_id(1)
+    writer.add_eos_token_id(2)
+
+    # Weights are stored as (out, in), the reverse of ggml's dimension order
+    writer.add_tensor("token_embd.weight", weight(len(tokens), n_embd))
+    for block in range(n_layer):
+        writer.add_tensor(f"blk.{block}.attn_norm.weight", norm())
+        for name in ["attn_q", "attn_k", "attn_v", "attn_output"]:
+            writer.add_tensor(f"blk.{block}.{name}.weight", weight(n_embd, n_embd))
+        writer.add_tensor(f"blk.{block}.ffn_norm.weight", norm())
+        writer.add_tensor(f"blk.{block}.ffn_gate.weight", weight(n_ff, n_embd))
+        writer.add_tensor(f"blk.{block}.ffn_up.weight", weight(n_ff, n_embd))
+        writer.add_tensor(f"blk.{block}.ffn_down.weight", weight(n_embd, n_ff))
+    writer.add_tensor("output_norm.weight", norm())
+    writer.add_tensor("output.weight", weight(len(tokens), n_embd))
+
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()
+    return len(tokens)
+
+
+if __name__ == "__main__":
+    localpath = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(
+        description="Write a tiny randomly initialised GGUF model, so that the Phi "
+        "benchmarks and processor can run in seconds without the real model. "
+        "Its decisions are meaningless."
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=os.path.join(localpath, "tiny-test.gguf"),
+        help="Path to write the model to.",
+    )
+    parser.add_argument(
+        "--corpus",
+        type=str,
+        default=None,
+        help="JSON file with a list of {incident, policy} objects, whose words are "
+        "added to the vocabulary.",
+    )
+    parser.add_argument("--n-embd", type=int, default=64)
+    parser.add_argument("--n-layer", type=int, default=2)
+    parser.add_argument("--n-head", type=int, default=4)
+    parser.add_argument("--n-ff", type=int, default=128)
+    parser.add_argument("--n-ctx", type=int, default=4096)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    texts = [preamble]
+    if args.corpus:
+        with open(args.corpus, "r") as corpus_file:
+            texts += [
+                json.dumps({"incident": case["incident"], "policy": case["policy"]})
+                for case in json.load(corpus_file)
+            ]
+
+    n_vocab = write_model(
+        args.output,
+        texts,
+        args.n_embd,
+        args.n_layer,
+        args.n_head,
+        args.n_ff,
+        args.n_ctx,
+        args.seed,
+    )
+    print(f"Wrote {args.output} with {n_vocab} tokens")
@@ -0,0 +1,283 @@
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import time
+
+import llama_cpp
+
+from phi import Phi, build_prompt
+
+incidents = [
+    {
+        "incident": "The policyholder hit a car",
+        "policy": "This policy covers all claims",
+    },
+    {
+        "incident": "A tree fell on the policyholder's car during a storm.",
+        "policy": "This policy covers accidents. Exclusions include natural disasters.",
+    },
+    {
+        "incident": "The policyholder's car was scratched by vandals overnight.",
+        "policy": "This policy covers damage from accidents and vandalism.",
+    },
+]
+
+
+def load_corpus(path):
+    if path is None:
+        return incidents
+    with open(path, "r") as corpus_file:
+        return json.load(corpus_file)
+
+
+def summarise(values):
+    return {
+        "mean": statistics.mean(values),
+        "median": statistics.median(values),
+        "min": min(values),
+        "max": max(values),
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def time_to_first_token(phi, incident, policy, use_prefix_cache):
+    if use_prefix_cache:
+        phi.restore_prefix()
+    else:
+        # Forget previous prompts so the whole prompt is evaluated
+        phi.llm.reset()
+
+    start = time.perf_counter()
+    stream = phi.llm.create_completion(
+        build_prompt(incident, policy), max_tokens=1, stream=True
+    )
+    next(iter(stream))
+    ttft = time.perf_counter() - start
+    for _ in stream:
+        pass
+    return ttft
+
+
+def benchmark_ttft(phi, corpus, runs, use_prefix_cache):
+    ttfts = [
+        time_to_first_token(phi, case["incident"], case["policy"], use_prefix_cache)
+        for _ in range(runs)
+        for case in corpus
+    ]
+    return {f"{key}_s": value for key, value in summarise(ttfts).items()}
+
+
+def benchmark_throughput(phi, corpus, runs, max_tokens):
+    """Prompt evaluation and generation speed from llama.cpp's own counters, for
+    the incident part of each prompt and an unconstrained completion."""
+    prompt_tokens = prompt_ms = generated_tokens = generation_ms = 0
+    for _ in range(runs):
+        for case in corpus:
+            phi.restore_prefix()
+            llama_cpp.llama_perf_context_reset(phi.llm.ctx)
+            phi.llm.create_completion(
+                build_prompt(case["incident"], case["policy"]),
+                max_tokens=max_tokens,
+                stop=["<|end|>"],
+            )
+            perf = llama_cpp.llama_perf_context(phi.llm.ctx)
+            prompt_tokens += perf.n_p_eval
+            prompt_ms += perf.t_p_eval_ms
+            generated_tokens += perf.n_eval
+            generation_ms += perf.t_eval_ms
+    return {
+        "prompt_tokens": prompt_tokens,
+        "prompt_tokens_per_s": prompt_tokens / prompt_ms * 1000 if prompt_ms else None,
+        "generated_tokens": generated_tokens,
+        "generation_tokens_per_s": (
+            generated_tokens / generation_ms * 1000 if generation_ms else None
+        ),
+    }
+
+
+def benchmark_decisions(phi, corpus, runs, repeats, batch_size=1):
+    start = time.perf_counter()
+    results = []
+    for _ in range(runs):
+        if batch_size > 1:
+            # Batches within a run, as process_batch decides identical cases once
+            cases = [(case["incident"], case["policy"]) for case in corpus]
+            for i in range(0, len(cases), batch_size):
+                results += phi.process_batch(cases[i : i + batch_size], repeats=repeats)
+            continue
+        for case in corpus:
+            if phi.engine == "score":
+                results.append(phi.score_incident(case["incident"], case["policy"])[0])
+            else:
+                results.append(
+                    phi.process_incident(
+                        case["incident"], case["policy"], repeats=repeats
+                    )
+                )
+    elapsed = time.perf_counter() - start
+
+    # Errors are counted from the results, as the stats count a case repeated
+    # within a batch once
+    stats = phi.stats
+    errors = sum(1 for result in results if result in {None, "error"})
+
+    def ratio(numerator, denominator):
+        return numerator / denominator if denominator else None
+
+    return {
+        **stats,
+        "cases": len(results),
+        "errors": errors,
+        "retries": stats["attempts"] - stats["decisions"],
+        "tokens_per_attempt": ratio(stats["completion_tokens"], stats["attempts"]),
+        "tokens_per_decision": ratio(stats["completion_tokens"], stats["decisions"]),
+        "attempts_per_decision": ratio(stats["attempts"], stats["decisions"]),
+        "seconds_per_case": elapsed / len(results),
+        "cases_per_s": len(results) / elapsed,
+    }
+
+
+def benchmark_config(args, corpus, config):
+    """Runs every benchmark for one llama configuration. Called in a fresh process,
+    so that the peak RSS is that of this configuration alone."""
+    start = time.perf_counter()
+    phi = Phi(args.model_path, **config)
+    report = {
+        **config,
+        "load_s": time.perf_counter() - start,
+        "prefix_tokens": len(phi.prefix_tokens),
+        "ttft_without_prefix_cache": benchmark_ttft(phi, corpus, args.runs, False),
+        "ttft_with_prefix_cache": benchmark_ttft(phi, corpus, args.runs, True),
+        "throughput": benchmark_throughput(phi, corpus, args.runs, args.max_tokens),
+        "decisions": {},
+    }
+    del phi
+
+    for engine in args.engines.split(","):
+        report["decisions"][engine] = {}
+        for batch_size in args.batch_sizes:
+            phi = Phi(args.model_path, engine=engine, **config)
+            report["decisions"][engine][batch_size] = benchmark_decisions(
+                phi, corpus, args.runs, args.repeats, batch_size
+            )
+            del phi
+
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+if __name__ == "__main__":
+    localpath = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model-path",
+        type=str,
+        default=os.path.join(localpath, "Phi-3-mini-4k-instruct-q4.gguf"),
+        help="Path to the GGUF model to benchmark.",
+    )
+    parser.add_argument(
+        "--corpus",
+        type=str,
+        default=None,
+        help="JSON file with a list of {incident, policy} objects to run. "
+        "Defaults to a few sample incidents.",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=3,
+        help="How many times each incident is run.",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=10,
+        help="How many times Phi may try to process an incident.",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=32,
+        help="Tokens to generate for each incident when measuring generation speed.",
+    )
+    parser.add_argument(
+        "--engines",
+        type=str,
+        default="generate,grammar,score",
+        help="Comma separated Phi engines to compare decisions for.",
+    )
+    parser.add_argument(
+        "--batch-sizes",
+        type=int_list,
+        default=[1],
+        help="Comma separated numbers of cases to decide together with "
+        "Phi.process_batch, where 1 decides them one at a time.",
+    )
+    parser.add_argument(
+        "--n-ctx",
+        type=int_list,
+        default=[1024],
+        help="Comma separated context sizes to sweep.",
+    )
+    parser.add_argument(
+        "--n-threads",
+        type=int_list,
+        default=[os.cpu_count()],
+        help="Comma separated thread counts to sweep.",
+    )
+    parser.add_argument(
+        "--n-batch",
+        type=int_list,
+        default=[512],
+        help="Comma separated batch sizes to sweep.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="File to write the JSON report to, for comparing between images.",
+    )
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    report = {
+        "model_path": args.model_path,
+        "model_size_bytes": os.path.getsize(args.model_path),
+        "llama_cpp_version": llama_cpp.__version__,
+        "python_version": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "corpus_size": len(corpus),
+        "runs": args.runs,
+        "configs": [],
+    }
+
+    spawn = multiprocessing.get_context("spawn")
+    for n_ctx, n_threads, n_batch in itertools.product(
+        args.n_ctx, args.n_threads, args.n_batch
+    ):
+        config = {"n_ctx": n_ctx, "n_threads": n_threads, "n_batch": n_batch}
+        print(f"Benchmarking {config}", flush=True)
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=spawn) as pool:
+            report["configs"].append(
+                pool.submit(benchmark_config, args, corpus, config).result()
+            )
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as report_file:
+            json.dump(report, report_file, indent=2)
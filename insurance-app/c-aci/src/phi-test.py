@@ -0,0 +1,36 @@
+import argparse
+
+from phi import Phi, build_prompt, preamble
+
+
+def example_answer(decision):
+    """The assessor's answer with decision, as the examples in the preamble give it."""
+    start = preamble.index("<|assessor|>") + len("<|assessor|>")
+    example = preamble[start : preamble.index("<|end|>", start) + len("<|end|>")]
+    for value in ["approve", "deny"]:
+        example = example.replace(f'"{value}"', f'"{decision}"')
+    return example
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that the score engine evaluates the decision in the same "
+        "context as a generated answer in the format of the preamble's examples."
+    )
+    parser.add_argument("--model-path", type=str, required=True)
+    args = parser.parse_args()
+
+    phi = Phi(args.model_path, prefix_cache=False, engine="score")
+    prompt = build_prompt("The policyholder hit a car", "This policy covers all claims")
+
+    context, approve, deny = phi.score_tokens(prompt)
+    for decision, token in [("approve", approve), ("deny", deny)]:
+        generated = phi.tokenize(prompt + example_answer(decision))
+        assert generated[: len(context)] == context, (
+            f"Scored context differs from the {decision} answer: "
+            f"{phi.llm.detokenize(context[-8:])!r} != "
+            f"{phi.llm.detokenize(generated[len(context) - 8 : len(context)])!r}"
+        )
+        assert generated[len(context)] == token, (decision, token)
+
+    print("Phi test successful")
@@ -1,6 +1,16 @@
-from llama_cpp import Llama
+import llama_cpp
+from llama_cpp import Llama, LlamaGrammar
+import numpy as np
+import hashlib
 import json
 import itertools
+import os
+import pickle
+import tempfile
+import time
+import weakref
+
+from file_digest import cached_file_digest
 
 preamble = """
 <|system|>
@@ -34,34 +44,472 @@ or
 """
 
 
+# Only allows the two valid decisions, so the result always parses
+decision_grammar = r"""
+root ::= "<result>{\"result\": \"" ("approve" | "deny") "\"}"
+"""
+
+# Every token is at least one character, so this always fits a whole decision
+grammar_max_tokens = len('<result>{"result": "approve"}')
+
+# The assessor's turn in the examples of the preamble, up to the decision
+example_answer_prefix = '\n<result>{"result": "'
+assert "<|assessor|>" + example_answer_prefix + "approve" in preamble
+
+# The scoring engine compares the likelihood of the decisions right after this,
+# as the examples put them
+score_prefix = example_answer_prefix
+
+# Generated decisions end at the first of these, as in create_completion
+stop_strings = ["<|end|>", "</result>"]
+max_decision_tokens = 100
+
+# Sequences decoded together by process_batch, besides the shared preamble
+max_batch_sequences = 32
+
+# Every prompt shares the preamble and the start of the user turn
+prompt_prefix = preamble + '\n<|user|>\n{"incident": "'
+
+# KV cache types which can be selected by name. Quantized value caches need
+# flash attention.
+kv_cache_types = {
+    "f32": llama_cpp.GGML_TYPE_F32,
+    "f16": llama_cpp.GGML_TYPE_F16,
+    "q8_0": llama_cpp.GGML_TYPE_Q8_0,
+    "q4_0": llama_cpp.GGML_TYPE_Q4_0,
+}
+
+
+def build_prompt(incident, policy):
+    return (
+        preamble
+        + f'\n<|user|>\n{{"incident": "{incident}", "policy": "{policy}"}}<|end|>\n<|accessor|>'
+    )
+
+
 class Phi:
-    def __init__(self, model_path="./Phi-3-mini-4k-instruct-q4.gguf"):
+    def __init__(
+        self,
+        model_path="./Phi-3-mini-4k-instruct-q4.gguf",
+        prefix_cache=True,
+        persist_prefix_cache=False,
+        engine="generate",
+        n_ctx=1024,
+        n_threads=None,
+        n_batch=512,
+        use_mmap=True,
+        use_mlock=False,
+        type_k=None,
+        type_v=None,
+        flash_attn=False,
+    ):
+        if engine not in {"generate", "grammar", "score"}:
+            raise ValueError(f"Unknown engine: {engine}")
+        for cache_type in [type_k, type_v]:
+            if cache_type is not None and cache_type not in kv_cache_types:
+                raise ValueError(f"Unknown KV cache type: {cache_type}")
+        self.engine = engine
+        self.grammar = None
+        if engine == "grammar":
+            self.grammar = LlamaGrammar.from_string(decision_grammar, verbose=False)
+        self.stats = {"decisions": 0, "attempts": 0, "completion_tokens": 0}
+        self.rng = np.random.default_rng()
+        self.batch_ctx = None
+
+        self.model_path = model_path
         self.llm = Llama(
             model_path=model_path,
-            n_ctx=1024,
+            n_ctx=n_ctx,
+            n_threads=n_threads,
+            n_batch=n_batch,
+            use_mmap=use_mmap,
+            use_mlock=use_mlock,
+            type_k=kv_cache_types.get(type_k),
+            type_v=kv_cache_types.get(type_v),
+            flash_attn=flash_attn,
         )
+        self.kv_cache_types = [type_k, type_v]
 
-    def process_incident(self, incident, policy, repeats=1) -> str:
-        prompt = (
-            preamble
-            + f'\n<|user|>\n{{"incident": "{incident}", "policy": "{policy}"}}<|end|>\n<|accessor|>'
-        )
+        self.prefix_tokens = None
+        self.prefix_state = None
+        if prefix_cache:
+            self.load_prefix_state(persist_prefix_cache)
 
-        for _ in range(repeats) if repeats is not None else itertools.cycle([1]):
-            result = self.llm.create_completion(
-                prompt, max_tokens=100, stop=["<|end|>", "</result>"]
-            )
-            print(result, flush=True)
+    def tokenize(self, text):
+        return self.llm.tokenize(text.encode("utf-8"), special=True)
+
+    def prefix_state_path(self):
+        # Keyed on everything that changes the evaluated state, so a new model,
+        # preamble, context size or KV cache type never restores a stale cache.
+        key = hashlib.sha256(
+            json.dumps(
+                [
+                    self.prefix_tokens,
+                    self.llm.n_ctx(),
+                    cached_file_digest(self.model_path),
+                    self.kv_cache_types,
+                ]
+            ).encode("utf-8")
+        ).hexdigest()[:16]
+        return f"{self.model_path}.prefix-{key}.state"
+
+    def load_prefix_state(self, persist=False):
+        # The last token is dropped as it may merge with the start of the incident
+        self.prefix_tokens = self.tokenize(prompt_prefix)[:-1]
 
+        path = self.prefix_state_path() if persist else None
+        if path and os.path.isfile(path):
+            print(f"Loading prefix state from {path}", flush=True)
             try:
-                result = result["choices"][0]["text"]
-                result = json.loads(result.split("<result>")[1])
-                if "result" not in result:
-                    continue
-                if result["result"].lower() not in {"approve", "deny"}:
-                    continue
-                return result["result"].lower()
+                with open(path, "rb") as state_file:
+                    self.prefix_state = pickle.load(state_file)
+                return
             except Exception as e:
-                print(e)
-                continue
+                # A truncated or corrupt state is evaluated again and replaced
+                print(f"Failed to load prefix state: {e}", flush=True)
+
+        print(f"Evaluating {len(self.prefix_tokens)} prefix tokens", flush=True)
+        self.llm.reset()
+        self.llm.eval(self.prefix_tokens)
+        self.prefix_state = self.llm.save_state()
+
+        if path:
+            print(f"Saving prefix state to {path}", flush=True)
+            # Workers starting together may all save the state, so each writes its
+            # own temporary file and the last to be renamed wins. The state is
+            # already loaded, so failing to save it only costs later starts.
+            try:
+                fd, tmp_path = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(path)),
+                    prefix=os.path.basename(path) + ".",
+                    suffix=".tmp",
+                )
+                try:
+                    with os.fdopen(fd, "wb") as state_file:
+                        pickle.dump(self.prefix_state, state_file)
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+            except OSError as e:
+                print(f"Failed to save prefix state: {e}", flush=True)
+
+    def restore_prefix(self):
+        if self.prefix_state is None:
+            return
+        # create_completion reuses any evaluated tokens which match the prompt, so
+        # the state only has to be restored once a previous prompt has diverged
+        # inside the prefix (or nothing has been evaluated yet).
+        n_prefix = len(self.prefix_tokens)
+        if (
+            self.llm.n_tokens < n_prefix
+            or self.llm.input_ids[:n_prefix].tolist() != self.prefix_tokens
+        ):
+            self.llm.load_state(self.prefix_state)
+
+    def set_threads(self, n_threads):
+        self.llm.n_threads = self.llm.n_threads_batch = n_threads
+        llama_cpp.llama_set_n_threads(self.llm.ctx, n_threads, n_threads)
+        if self.batch_ctx is not None:
+            llama_cpp.llama_set_n_threads(self.batch_ctx, n_threads, n_threads)
+
+    def tune_threads(self, incident, policy, candidates):
+        """Times the whole prompt for incident and policy with each of the candidate
+        thread counts, and keeps the fastest. Returns it and the timings."""
+        timings = {}
+        for n_threads in candidates:
+            self.set_threads(n_threads)
+            # Forget previous prompts so the whole prompt is evaluated
+            self.llm.reset()
+            start = time.perf_counter()
+            self.llm.create_completion(build_prompt(incident, policy), max_tokens=16)
+            timings[n_threads] = time.perf_counter() - start
+            print(f"{n_threads} threads took {timings[n_threads]:.3f}s", flush=True)
+
+        best = min(timings, key=timings.get)
+        self.set_threads(best)
+        return best, timings
+
+    def score_tokens(self, prompt):
+        """Returns the tokens of prompt up to the decision, and the first tokens of
+        approve and deny after them."""
+        # Tokenize both answers in context, as the tokenizer may merge the start of
+        # the answer with the preceding quote.
+        approve = self.tokenize(prompt + score_prefix + "approve")
+        deny = self.tokenize(prompt + score_prefix + "deny")
+        n_context = 0
+        for a, d in zip(approve, deny):
+            if a != d:
+                break
+            n_context += 1
+        return approve[:n_context], approve[n_context], deny[n_context]
+
+    def score_logits(self, logits, approve, deny):
+        logprobs = Llama.logits_to_logprobs(logits)
+        margin = float(logprobs[approve] - logprobs[deny])
+        decision = "approve" if margin >= 0 else "deny"
+        print({"decision": decision, "margin": margin}, flush=True)
+        self.stats["attempts"] += 1
+        return decision, margin
+
+    def score_prompt(self, prompt):
+        """Returns the more likely decision for prompt, and the difference between
+        the log-probabilities of approve and deny."""
+        context, approve, deny = self.score_tokens(prompt)
+
+        self.restore_prefix()
+        # Reuse the evaluated tokens shared with the context, but always evaluate at
+        # least the final token to get its logits.
+        n_reuse = 0
+        for a, c in zip(self.llm.input_ids[: self.llm.n_tokens].tolist(), context):
+            if a != c:
+                break
+            n_reuse += 1
+        self.llm.n_tokens = min(n_reuse, len(context) - 1)
+        self.llm.eval(context[self.llm.n_tokens :])
+
+        logits = np.ctypeslib.as_array(
+            llama_cpp.llama_get_logits_ith(self.llm.ctx, -1),
+            shape=(self.llm.n_vocab(),),
+        )
+        return self.score_logits(logits, approve, deny)
+
+    def score_incident(self, incident, policy):
+        decision, margin = self.score_prompt(build_prompt(incident, policy))
+        self.stats["decisions"] += 1
+        return decision, margin
+
+    def attempt(self, prompt):
+        if self.engine == "score":
+            return self.score_prompt(prompt)[0]
+
+        self.restore_prefix()
+        result = self.llm.create_completion(
+            prompt,
+            max_tokens=(
+                max_decision_tokens if self.grammar is None else grammar_max_tokens
+            ),
+            stop=stop_strings,
+            grammar=self.grammar,
+        )
+        print(result, flush=True)
+        self.stats["attempts"] += 1
+        self.stats["completion_tokens"] += result["usage"]["completion_tokens"]
+        return self.parse_decision(result["choices"][0]["text"])
+
+    def parse_decision(self, text):
+        try:
+            result = json.loads(text.split("<result>")[1])
+            if "result" not in result:
+                return None
+            if result["result"].lower() not in {"approve", "deny"}:
+                return None
+            return result["result"].lower()
+        except Exception as e:
+            print(e)
+            return None
+
+    def process_incident(self, incident, policy, repeats=1) -> str:
+        prompt = build_prompt(incident, policy)
+
+        for _ in range(repeats) if repeats is not None else itertools.cycle([1]):
+            decision = self.attempt(prompt)
+            if decision is not None:
+                self.stats["decisions"] += 1
+                return decision
         return "error"
+
+    def process_batch(self, cases, repeats=1):
+        """Decides each of the (incident, policy) pairs in cases, returning one
+        decision per case in the same order."""
+        # Identical claims are only evaluated once
+        prompts = [build_prompt(incident, policy) for incident, policy in cases]
+        decisions = dict.fromkeys(prompts, "error")
+        pending = list(decisions)
+
+        # Each round makes one attempt per undecided case, so a case which keeps
+        # failing to parse does not hold up the rest of the batch.
+        for _ in range(repeats) if repeats is not None else itertools.cycle([1]):
+            if not pending:
+                break
+            if len(pending) > 1 and self.grammar is None:
+                attempts = self.decode_batch(pending)
+            else:
+                # Grammars constrain a single sequence, so are decided one at a time
+                attempts = [self.attempt(prompt) for prompt in pending]
+            undecided = []
+            for prompt, decision in zip(pending, attempts):
+                if decision is None:
+                    undecided.append(prompt)
+                else:
+                    self.stats["decisions"] += 1
+                    decisions[prompt] = decision
+            pending = undecided
+
+        return [decisions[prompt] for prompt in prompts]
+
+    def batch_context(self):
+        """A context decoding up to max_batch_sequences sequences at once, with the
+        preamble evaluated once as sequence 0. Llama only creates contexts for a
+        single sequence, so this is a second context on the same model weights,
+        with its own KV cache of n_ctx tokens shared by all the sequences."""
+        if self.batch_ctx is not None:
+            return self.batch_ctx
+
+        params = llama_cpp.llama_context_params.from_buffer_copy(
+            self.llm.context_params
+        )
+        params.n_seq_max = min(
+            max_batch_sequences + 1, llama_cpp.llama_max_parallel_sequences()
+        )
+        params.kv_unified = True
+        ctx = llama_cpp.llama_init_from_model(self.llm.model, params)
+        if ctx is None:
+            raise ValueError("Failed to create the batch decoding context")
+        weakref.finalize(self, llama_cpp.llama_free, ctx)
+        self.batch_ctx = ctx
+        self.batch_memory = llama_cpp.llama_get_memory(ctx)
+        self.batch_sequences = params.n_seq_max - 1
+        self.batch = llama_cpp.llama_batch_init(params.n_batch, 0, 1)
+        weakref.finalize(self, llama_cpp.llama_batch_free, self.batch)
+
+        # The last token is dropped as it may merge with the start of the incident
+        self.batch_prefix = self.tokenize(prompt_prefix)[:-1]
+        print(
+            f"Evaluating {len(self.batch_prefix)} prefix tokens for batches", flush=True
+        )
+        list(
+            self.decode(
+                [(token, i, 0, False) for i, token in enumerate(self.batch_prefix)]
+            )
+        )
+        return ctx
+
+    def decode(self, entries):
+        """Decodes the (token, position, sequence, logits) entries in the batch
+        context, as many at a time as n_batch allows. Yields (sequence, logits) for
+        the entries which want logits, before they are overwritten."""
+        n_batch = self.llm.context_params.n_batch
+        for start in range(0, len(entries), n_batch):
+            chunk = entries[start : start + n_batch]
+            for i, (token, position, sequence, logits) in enumerate(chunk):
+                self.batch.token[i] = token
+                self.batch.pos[i] = position
+                self.batch.n_seq_id[i] = 1
+                self.batch.seq_id[i][0] = sequence
+                self.batch.logits[i] = logits
+            self.batch.n_tokens = len(chunk)
+            if llama_cpp.llama_decode(self.batch_ctx, self.batch) != 0:
+                raise ValueError("Failed to decode batch")
+            for i, (_, _, sequence, logits) in enumerate(chunk):
+                if logits:
+                    yield sequence, np.ctypeslib.as_array(
+                        llama_cpp.llama_get_logits_ith(self.batch_ctx, i),
+                        shape=(self.llm.n_vocab(),),
+                    ).copy()
+
+    def sample(self, logits, top_k=40, top_p=0.95, min_p=0.05, temperature=0.8):
+        """Samples a token like create_completion does with its defaults."""
+        top = np.argpartition(logits, -top_k)[-top_k:]
+        top = top[np.argsort(logits[top])[::-1]]
+        probs = np.exp((logits[top] - logits[top[0]]) / temperature)
+        probs /= probs.sum()
+        keep = min(
+            int(np.searchsorted(np.cumsum(probs), top_p)) + 1,
+            int(np.count_nonzero(probs >= min_p * probs[0])),
+        )
+        return int(self.rng.choice(top[:keep], p=probs[:keep] / probs[:keep].sum()))
+
+    def decode_batch(self, prompts):
+        """Makes one attempt at each of prompts, decoding them together as separate
+        sequences which share the evaluated preamble, so that each step of the
+        model evaluates a token of every sequence. Returns a decision or None for
+        each prompt."""
+        self.batch_context()
+        cases = []
+        for prompt in prompts:
+            if self.engine == "score":
+                tokens, approve, deny = self.score_tokens(prompt)
+                cells = 0
+            else:
+                tokens, approve, deny = self.tokenize(prompt), None, None
+                cells = max_decision_tokens
+            # Share the evaluated preamble, but evaluate at least the last token
+            n_shared = 0
+            for a, b in zip(self.batch_prefix, tokens[:-1]):
+                if a != b:
+                    break
+                n_shared += 1
+            cells += len(tokens) - n_shared
+            cases.append((tokens, n_shared, cells, approve, deny))
+
+        # As many sequences as fit in the KV cache next to the preamble
+        free = self.llm.n_ctx() - len(self.batch_prefix)
+        decisions = []
+        chunk, used = [], 0
+        for case in cases:
+            if chunk and (used + case[2] > free or len(chunk) == self.batch_sequences):
+                decisions.extend(self.decode_chunk(chunk))
+                chunk, used = [], 0
+            chunk.append(case)
+            used += case[2]
+        decisions.extend(self.decode_chunk(chunk))
+        return decisions
+
+    def decode_chunk(self, cases):
+        sequences = range(1, len(cases) + 1)
+        try:
+            entries = []
+            for sequence, (tokens, n_shared, _, _, _) in zip(sequences, cases):
+                llama_cpp.llama_memory_seq_cp(
+                    self.batch_memory, 0, sequence, 0, n_shared
+                )
+                entries.extend(
+                    (token, position, sequence, position == len(tokens) - 1)
+                    for position, token in enumerate(tokens)
+                    if position >= n_shared
+                )
+            logits = dict(self.decode(entries))
+
+            if self.engine == "score":
+                return [
+                    self.score_logits(logits[sequence], approve, deny)[0]
+                    for sequence, (_, _, _, approve, deny) in zip(sequences, cases)
+                ]
+
+            generated = {sequence: [] for sequence in sequences}
+            texts = {}
+            positions = {
+                sequence: len(tokens)
+                for sequence, (tokens, *_) in zip(sequences, cases)
+            }
+            while logits:
+                step = []
+                for sequence, sequence_logits in logits.items():
+                    token = self.sample(sequence_logits)
+                    generated[sequence].append(token)
+                    text = self.llm.detokenize(
+                        generated[sequence], special=True
+                    ).decode("utf-8", errors="ignore")
+                    stops = [text.find(stop) for stop in stop_strings if stop in text]
+                    if (
+                        stops
+                        or token == self.llm.token_eos()
+                        or len(generated[sequence]) >= max_decision_tokens
+                    ):
+                        texts[sequence] = text[: min(stops)] if stops else text
+                        continue
+                    step.append((token, positions[sequence], sequence, True))
+                    positions[sequence] += 1
+                logits = dict(self.decode(step))
+        finally:
+            for sequence in sequences:
+                llama_cpp.llama_memory_seq_rm(self.batch_memory, sequence, -1, -1)
+
+        decisions = []
+        for sequence in sequences:
+            print({"text": texts[sequence]}, flush=True)
+            self.stats["attempts"] += 1
+            self.stats["completion_tokens"] += len(generated[sequence])
+            decisions.append(self.parse_decision(texts[sequence]))
+        return decisions
@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+import attestation_service_pb2 as as_pb
+
+# disables the "verify=False" warnings, as the test server uses a self-signed certificate
+import urllib3
+
+urllib3.disable_warnings()
+
+localpath = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_processor_module():
+    spec = importlib.util.spec_from_file_location(
+        "acl_processor", os.path.join(localpath, "acl-processor.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class MockPhi:
+    """Stand-in for Phi which approves every incident after a fixed delay, so the
+    benchmark measures the processor rather than the model."""
+
+    def __init__(self, inference_ms):
+        self.delay = inference_ms / 1000
+        self.stats = {"decisions": 0, "attempts": 0, "completion_tokens": 0}
+
+    def decide(self):
+        time.sleep(self.delay)
+        self.stats["decisions"] += 1
+        self.stats["attempts"] += 1
+        return "approve"
+
+    def process_incident(self, incident, policy, repeats=10):
+        return self.decide()
+
+    def process_batch(self, cases, repeats=10):
+        return [self.decide() for _ in cases]
+
+    def score_incident(self, incident, policy):
+        return self.decide(), 1.0
+
+
+def benchmark_daemon(daemon_class, inference_ms):
+    class BenchmarkDaemon(daemon_class):
+        def create_phi(self):
+            return MockPhi(inference_ms)
+
+    return BenchmarkDaemon
+
+
+def start_test_server(args):
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(localpath, "test-server.py"),
+            "--quiet",
+            f"--port={args.port}",
+            f"--cases={args.cases}",
+            f"--lease-seconds={args.lease_seconds}",
+            f"--latency-ms={args.latency_ms}",
+            f"--latency-distribution={args.latency_distribution}",
+            f"--error-rate={args.error_rate}",
+            f"--malformed-rate={args.malformed_rate}",
+        ],
+        stdout=subprocess.DEVNULL,
+        cwd=localpath,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(test_server_url(args) + "/stats", verify=False)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.terminate()
+    raise ValueError("Test server did not start")
+
+
+def test_server_url(args):
+    return f"https://localhost:{args.port}"
+
+
+def run_processor(processor, args):
+    if args.mode == "async":
+        asyncio.run(processor.run(queue_depth=args.queue_depth))
+        return
+    processor.setup_acl()
+    if args.mode == "pipelined":
+        processor.start_pipelined_processing(
+            args.workers,
+            args.queue_depth,
+            args.batch_size,
+            report_interval=3600,
+            post_batch_size=args.post_batch_size,
+        )
+    else:
+        processor.start_processing()
+
+
+def summarise(stats, cases):
+    report = {"cases": stats["cases"], "decided": stats["decided"]}
+    if stats["decided"] > 0:
+        elapsed = stats["last_decision"] - stats["first_fetch"]
+        report["elapsed_s"] = elapsed
+        report["cases_per_s"] = stats["decided"] / elapsed if elapsed > 0 else None
+    if "fetch_to_post_s" in stats:
+        report["fetch_to_post_s"] = stats["fetch_to_post_s"]
+    report["requests_per_case"] = {
+        rule: count / cases for rule, count in sorted(stats["requests"].items())
+    }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure processor throughput against test-server.py with a mock Phi."
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["sequential", "pipelined", "async"],
+        default="sequential",
+    )
+    parser.add_argument("--cases", type=int, default=100)
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument(
+        "--inference-ms",
+        type=float,
+        default=50,
+        help="Time the mock Phi takes for each decision.",
+    )
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument(
+        "--latency-distribution",
+        choices=["fixed", "uniform", "exponential"],
+        default="exponential",
+    )
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=2,
+        help="How long before the test server hands out a case again, e.g. after "
+        "an injected error when posting its decision.",
+    )
+    parser.add_argument("--malformed-rate", type=float, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--queue-depth", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--prefetch", type=int, default=1)
+    parser.add_argument("--post-batch-size", type=int, default=1)
+    parser.add_argument(
+        "--lease-margin",
+        type=float,
+        default=0.5,
+        help="Seconds before a lease expires at which the processor drops a case, "
+        "which has to be well within --lease-seconds.",
+    )
+    parser.add_argument("--http-pool-size", type=int, default=4)
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=600,
+        help="Give up if the cases are not all decided within this many seconds.",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show the processor's output."
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="File to write the JSON report to."
+    )
+    args = parser.parse_args()
+
+    module = load_processor_module()
+    daemon_class = (
+        module.AsyncProcessorDaemon if args.mode == "async" else module.ProcessorDaemon
+    )
+    processor = benchmark_daemon(daemon_class, args.inference_ms)(
+        uds_sock="/dev/null",
+        acl_url=f"localhost:{args.port}",
+        phi_repeats=1,
+        http_pool_size=args.http_pool_size,
+        prefetch=args.prefetch,
+        lease_margin=args.lease_margin,
+    )
+
+    # The fingerprint is known before registering, so it does not need the sidecar
+    processor.attestation_cache.put(
+        hashlib.sha256(processor.fingerprint.encode("utf-8")).digest(),
+        as_pb.FetchAttestationReply(
+            attestation=b"attestation",
+            platform_certificates=b"platform_certificates",
+            uvm_endorsements=b"uvm_endorsements",
+        ),
+        processor.cert_expiry,
+    )
+
+    server = start_test_server(args)
+    try:
+        output = open(os.devnull, "w") if not args.verbose else sys.stdout
+        with contextlib.redirect_stdout(output):
+            threading.Thread(
+                target=run_processor, args=(processor, args), daemon=True
+            ).start()
+            deadline = time.time() + args.timeout
+            while time.time() < deadline:
+                stats = requests.get(
+                    test_server_url(args) + "/stats", verify=False
+                ).json()
+                if stats["decided"] == stats["cases"]:
+                    break
+                time.sleep(0.2)
+    finally:
+        server.terminate()
+        server.wait()
+
+    report = {
+        "mode": args.mode,
+        "inference_ms": args.inference_ms,
+        "latency_ms": args.latency_ms,
+        "latency_distribution": args.latency_distribution,
+        "error_rate": args.error_rate,
+        "malformed_rate": args.malformed_rate,
+        "prefetch": args.prefetch,
+        "lease_margin": args.lease_margin,
+        "post_batch_size": args.post_batch_size,
+        **summarise(stats, args.cases),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if stats["decided"] != stats["cases"]:
+        print(f"Only {stats['decided']} of {stats['cases']} cases were decided")
+        sys.exit(1)
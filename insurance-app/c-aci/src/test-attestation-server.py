@@ -0,0 +1,44 @@
+from concurrent import futures
+import argparse
+import os
+
+import grpc
+
+import attestation_service_pb2 as as_pb
+import attestation_service_pb2_grpc as as_grpc
+
+
+class StandInAttestationContainer(as_grpc.AttestationContainerServicer):
+    def __init__(self):
+        self.requests = 0
+
+    def FetchAttestation(self, request, context):
+        self.requests += 1
+        print(
+            f"Attestation request {self.requests} for {request.report_data.hex()}",
+            flush=True,
+        )
+        # Not a real SEV-SNP report, the ACL will reject registrations using it
+        return as_pb.FetchAttestationReply(
+            attestation=b"stand-in attestation for " + request.report_data,
+            platform_certificates=b"stand-in platform certificates",
+            uvm_endorsements=b"stand-in uvm endorsements",
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uds-sock", type=str, default="/tmp/attestation.sock")
+    args = parser.parse_args()
+
+    if os.path.exists(args.uds_sock):
+        os.remove(args.uds_sock)
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    as_grpc.add_AttestationContainerServicer_to_server(
+        StandInAttestationContainer(), server
+    )
+    server.add_insecure_port(f"unix://{args.uds_sock}")
+    server.start()
+    print(f"Serving stand-in attestation sidecar on {args.uds_sock}", flush=True)
+    server.wait_for_termination()
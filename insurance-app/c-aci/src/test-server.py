@@ -1,11 +1,213 @@
 from flask import Flask, jsonify, request
-from itertools import cycle
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import (
+    ServerHandler,
+    WSGIRequestHandler,
+    WSGIServer,
+    make_server,
+)
 import argparse
+import random
+import statistics
+import threading
+import time
 
-from crypto import generate_or_read_cert
+from identity import load_identity
 
 app = Flask(__name__)
 
+# Malformed responses, served instead of a case at --malformed-rate to exercise
+# the processor's validation
+malformed_cases = [
+    {"caseId": 1, "policy": "This policy covers all claims"},
+    {"caseId": 1, "incident": "The policyholder hit a car"},
+    {
+        "incident": "The policyholder hit a car",
+        "policy": "This policy covers all claims",
+    },
+    {
+        "caseId": "asdf",
+        "incident": "The policyholder hit a car",
+        "policy": "This policy covers all claims",
+    },
+    None,
+]
+
+
+class CaseQueue:
+    """Stand-in for the ACL app's case queue, recording when each case is first
+    handed out and decided."""
+
+    def __init__(self, cases, lease_seconds=300):
+        self.lock = threading.Lock()
+        self.cases = {}
+        self.queue = deque()
+        self.lease_seconds = lease_seconds
+        self.leases = {}
+        self.requests = Counter()
+        self.started = time.time()
+        for case_id in range(cases):
+            self.add_case(case_id)
+
+    def add_case(self, case_id):
+        self.cases[case_id] = {
+            "incident": f"The policyholder hit car number {case_id}",
+            "policy": "This policy covers all claims",
+            "decision": "",
+            "fetched": None,
+            "decided": None,
+        }
+        self.queue.append(case_id)
+
+    def next_case(self):
+        with self.lock:
+            # Like the ACL app, lease the case until it has a decision, handing it
+            # out again only once the lease expires
+            now = time.time()
+            expired = [c for c, expiry in self.leases.items() if expiry <= now]
+            if expired:
+                case_id = min(expired)
+            elif self.queue:
+                case_id = self.queue.popleft()
+            else:
+                return None
+            self.leases[case_id] = now + self.lease_seconds
+            case = self.cases[case_id]
+            if case["fetched"] is None:
+                case["fetched"] = time.time()
+            return (
+                case_id,
+                {"incident": case["incident"], "policy": case["policy"]},
+                self.leases[case_id],
+            )
+
+    def decide(self, case_id, decision):
+        with self.lock:
+            case = self.cases.get(case_id)
+            if case is None:
+                return 404, "Case not found"
+            if case["decision"] != "":
+                return 400, "Already stored decision for case."
+            case["decision"] = decision
+            case["decided"] = time.time()
+            self.leases.pop(case_id, None)
+            if case_id in self.queue:
+                self.queue.remove(case_id)
+            return 200, ""
+
+    def stats(self):
+        with self.lock:
+            decided = [c for c in self.cases.values() if c["decided"] is not None]
+            latencies = sorted(c["decided"] - c["fetched"] for c in decided)
+            report = {
+                "cases": len(self.cases),
+                "decided": len(decided),
+                "pending": len(self.queue),
+                "leased": len(self.leases),
+                "requests": dict(self.requests),
+                "elapsed_s": time.time() - self.started,
+            }
+            if decided:
+                report["first_fetch"] = min(c["fetched"] for c in decided)
+                report["last_decision"] = max(c["decided"] for c in decided)
+            if len(latencies) >= 2:
+                percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+                report["fetch_to_post_s"] = {
+                    "p50": percentiles[49],
+                    "p95": percentiles[94],
+                    "p99": percentiles[98],
+                    "max": latencies[-1],
+                }
+            return report
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """Serves the app over kept-alive HTTP/1.1 connections, as the ACL does, so
+    that requests do not each pay for a TLS handshake. The werkzeug development
+    server behind app.run closes the connection after every response."""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which Nagle's algorithm would
+    # hold back until the client acknowledges the headers
+    disable_nagle_algorithm = True
+    quiet = False
+
+    # Handles requests until the connection is closed, rather than just one
+    handle = BaseHTTPRequestHandler.handle
+
+    def handle_one_request(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline or len(self.raw_requestline) > 65536:
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+        handler = ServerHandler(
+            self.rfile,
+            self.wfile,
+            self.get_stderr(),
+            self.get_environ(),
+            multithread=True,
+        )
+        handler.http_version = "1.1"
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def simulate_latency():
+    mean = app.config["LATENCY_MS"] / 1000
+    distribution = app.config["LATENCY_DISTRIBUTION"]
+    if mean <= 0:
+        return
+    if distribution == "fixed":
+        time.sleep(mean)
+    elif distribution == "uniform":
+        time.sleep(random.uniform(0, 2 * mean))
+    elif distribution == "exponential":
+        time.sleep(random.expovariate(1 / mean))
+
+
+def injected_error():
+    return random.random() < app.config["ERROR_RATE"]
+
+
+@app.before_request
+def before_request():
+    if request.path == "/stats":
+        return
+    app.config["CASES"].requests[
+        request.url_rule.rule if request.url_rule else "?"
+    ] += 1
+    simulate_latency()
+    if request.path.startswith("/app/cases") and injected_error():
+        return "Injected error", 500
+
+
+@app.after_request
+def drain_request(response):
+    # The next request on a kept-alive connection starts after this one's body,
+    # which responses such as injected errors return without reading. Requests
+    # without a length have no body, and reading one would wait for the next.
+    if request.content_length:
+        request.get_data()
+    return response
+
+
+@app.route("/node/network", methods=["GET"])
+def get_network():
+    print("Requested service certificate")
+    return jsonify({"service_certificate": app.config["SERVICE_CERT"]}), 200
+
 
 @app.route("/app/ccf-cert", methods=["GET"])
 def get_user_cert():
@@ -20,57 +222,139 @@ def register_processor():
     return "", 200
 
 
-incidents = cycle(
-    [
-        {
-            "caseId": 1,
-            "incident": "The policyholder hit a car",
-            "policy": "This policy covers all claims",
-        },
-        {
-            "caseId": 2,
-            "incident": "The policyholder hit a car",
-            "policy": "This policy denies all claims",
-        },
-        {"caseId": 1, "policy": "This policy covers all claims"},
-        {"caseId": 1, "incident": "The policyholder hit a car"},
-        {
-            "incident": "The policyholder hit a car",
-            "policy": "This policy covers all claims",
-        },
-        {
-            "caseId": "asdf",
-            "incident": "The policyholder hit a car",
-            "policy": "This policy covers all claims",
-        },
-        None,
-    ]
-)
+def case_response(case_id, metadata, lease_expiry):
+    # The ACL app gives the lease expiry in milliseconds since the epoch
+    return {
+        "caseId": case_id,
+        "metadata": metadata,
+        "leaseExpiry": int(lease_expiry * 1000),
+    }
 
 
 @app.route("/app/cases/next", methods=["GET"])
 def get_next_incident():
-    response = next(incidents)
-    if response is not None:
-        print(f"Getting next incident as: {response}")
-        return jsonify(response), 200
-    else:
-        print("Getting next incident as asdf")
-        return "asdf", 200
+    count = request.args.get("count", type=int)
+    if count is None:
+        if random.random() < app.config["MALFORMED_RATE"]:
+            response = random.choice(malformed_cases)
+            print(f"Getting next incident as malformed: {response}")
+            if response is None:
+                return "asdf", 200
+            return jsonify(response), 200
 
+        next_case = app.config["CASES"].next_case()
+        if next_case is None:
+            return "No cases found", 404, {"retry-after": "1"}
+        return jsonify(case_response(*next_case)), 200
 
-@app.route("/app/cases/indexed/<caseId>/decision", methods=["PUT"])
+    # Malformed cases are mixed in with the valid ones
+    cases = []
+    for _ in range(count):
+        if random.random() < app.config["MALFORMED_RATE"]:
+            cases.append(random.choice(malformed_cases))
+            continue
+        next_case = app.config["CASES"].next_case()
+        if next_case is None:
+            break
+        cases.append(case_response(*next_case))
+    if not cases:
+        return "No cases found", 404, {"retry-after": "1"}
+    return jsonify({"cases": cases}), 200
+
+
+@app.route("/app/cases/indexed/<caseId>/decision", methods=["POST"])
 def put_incident_decision(caseId):
-    print(f"Setting decision for {caseId}")
-    print(request.get_json())
-    return "", 200
+    body = request.get_json()
+    if body.get("decision") not in {"approve", "deny", "error"}:
+        return "Missing or invalid decision", 400
+    status, text = app.config["CASES"].decide(int(caseId), body["decision"])
+    return text, status
+
+
+@app.route("/app/cases/decisions/batch", methods=["POST"])
+def put_incident_decisions():
+    results = []
+    for item in request.get_json()["decisions"]:
+        if item.get("decision") not in {"approve", "deny", "error"}:
+            status, text = 400, "Missing or invalid decision"
+        else:
+            status, text = app.config["CASES"].decide(
+                int(item["caseId"]), item["decision"]
+            )
+        result = {"caseId": item["caseId"], "statusCode": status}
+        if status != 200:
+            result["error"] = text
+        results.append(result)
+    return jsonify({"results": results}), 200
+
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    return jsonify(app.config["CASES"].stats()), 200
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--cases", type=int, default=2, help="Number of pending cases to serve."
+    )
+    parser.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=300,
+        help="How long a case is leased to a processor before it is handed out again.",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0,
+        help="Mean latency added to every response.",
+    )
+    parser.add_argument(
+        "--latency-distribution",
+        choices=["fixed", "uniform", "exponential"],
+        default="fixed",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0,
+        help="Fraction of case requests which fail with a 500.",
+    )
+    parser.add_argument(
+        "--malformed-rate",
+        type=float,
+        default=0,
+        help="Fraction of /app/cases/next responses which are malformed.",
+    )
+    parser.add_argument(
+        "--quiet", action="store_true", help="Do not log every request."
+    )
     args = parser.parse_args()
 
-    keypath, certpath = generate_or_read_cert()
+    app.config["CASES"] = CaseQueue(args.cases, args.lease_seconds)
+    app.config["LATENCY_MS"] = args.latency_ms
+    app.config["LATENCY_DISTRIBUTION"] = args.latency_distribution
+    app.config["ERROR_RATE"] = args.error_rate
+    app.config["MALFORMED_RATE"] = args.malformed_rate
+
+    KeepAliveRequestHandler.quiet = args.quiet
+
+    service_identity = load_identity()
+    app.config["SERVICE_CERT"] = service_identity.cert_pem
 
-    app.run(debug=True, port=args.port, ssl_context=(certpath, keypath))
+    server = make_server(
+        "127.0.0.1",
+        args.port,
+        app,
+        server_class=ThreadingWSGIServer,
+        handler_class=KeepAliveRequestHandler,
+    )
+    # Handshakes happen on each connection's thread, rather than when accepting
+    server.socket = service_identity.ssl_context(server=True).wrap_socket(
+        server.socket, server_side=True, do_handshake_on_connect=False
+    )
+    server.base_environ["HTTPS"] = "on"
+    print(f"Serving on https://127.0.0.1:{args.port}", flush=True)
+    server.serve_forever()